@@ -0,0 +1,106 @@
+import os
+import sys
+import json
+import time
+import resource
+import subprocess
+from argparse import ArgumentParser
+
+import numpy as np
+
+"""
+Step time and peak memory on CPU of the mnist cluster loss model of
+src/model_functions/test_clustLoss_mnist.py, compiled as the current graph
+and with jit_compile (head, cluster layer and both losses in one XLA
+cluster). Both are also run with the model built in the scope of a single
+device MirroredStrategy, as in src/utils/model_utility_multi.py, where the
+train step holds the merge calls of the optimizer and the cluster update
+(model_utility_multi ignores jit_compile with more than one replica).
+Every mode runs in its own process, so that the peak resident memory
+(ru_maxrss) of one does not hide the other. The batches are random mnist
+shaped images, no download is needed.
+
+run: python -m src.benchmarks.cluster_loss_jit -b 256 -n 100
+"""
+
+
+modes = ['graph', 'jit', 'mirrored_graph', 'mirrored_jit']
+
+
+def run_mode(mode: str, batch_size: int, number_of_steps: int,
+             warmup: int = 5):
+    import tensorflow as tf
+    from src.model_functions.test_clustLoss_mnist import create_model
+
+    tf.keras.utils.set_random_seed(0)
+    jit_compile = mode.endswith('jit')
+    if mode.startswith('mirrored'):
+        strategy = tf.distribute.MirroredStrategy(['/cpu:0'])
+        with strategy.scope():
+            model = create_model(np.ones(10).astype('float32'), jit_compile)
+    else:
+        model = create_model(np.ones(10).astype('float32'), jit_compile)
+
+    rng = np.random.RandomState(0)
+    images = rng.rand(batch_size, 28, 28, 1).astype('float32')
+    labels = np.eye(10, dtype='float32')[rng.randint(0, 10, batch_size)]
+    cluster = np.zeros((batch_size,), dtype='float32')
+
+    # the first steps trace (and compile with XLA) the train function
+    for _ in range(warmup):
+        model.train_on_batch([images, labels], [labels, cluster])
+
+    start = time.perf_counter()
+    for _ in range(number_of_steps):
+        losses = model.train_on_batch([images, labels], [labels, cluster])
+    step_time = (time.perf_counter() - start) / number_of_steps
+
+    return {'mode': mode,
+            'step_ms': 1000 * step_time,
+            'images_per_second': batch_size / step_time,
+            # kilobytes on linux
+            'peak_memory_mb': resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'loss': float(losses[0])}
+
+
+def benchmark(batch_size: int, number_of_steps: int):
+    results = []
+    for mode in modes:
+        command = [sys.executable, '-m', 'src.benchmarks.cluster_loss_jit',
+                   '-b', str(batch_size), '-n', str(number_of_steps),
+                   '--mode', mode]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE,
+                                env=dict(os.environ, CUDA_VISIBLE_DEVICES=''),
+                                universal_newlines=True).stdout
+        # the result is the last line, after the tf logs
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    print('** batch {}, {} steps on CPU **'.format(batch_size, number_of_steps))
+    for result in results:
+        print('{:<16} {:>8.2f} ms/step {:>10.1f} img/s {:>8.1f} MB peak'.format(
+            result['mode'],
+            result['step_ms'],
+            result['images_per_second'],
+            result['peak_memory_mb']))
+    print('speed up: {:.2f}x, mirrored {:.2f}x'.format(
+        results[0]['step_ms'] / results[1]['step_ms'],
+        results[2]['step_ms'] / results[3]['step_ms']))
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-b", "--batch_size", type=int, default=256,
+                        help="batch size")
+    parser.add_argument("-n", "--number", type=int, default=100,
+                        help="number of timed steps")
+    parser.add_argument("--mode", default=None, choices=modes,
+                        help="run a single mode, used internally")
+
+    args = parser.parse_args()
+
+    if args.mode is None:
+        benchmark(args.batch_size, args.number)
+    else:
+        print(json.dumps(run_mode(args.mode, args.batch_size, args.number)))
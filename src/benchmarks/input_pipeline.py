@@ -0,0 +1,498 @@
+import os
+import json
+import time
+import resource
+import tempfile
+import itertools
+from argparse import ArgumentParser
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from src.utils.generators import get_generator
+from src.utils.generators import ClassBalancedSampler
+from src.utils.generators import get_cluster_generator
+from src.utils.data_augmentation import get_data_generator
+from src.utils.data_augmentation import get_preprocessing_function
+from src.utils.batch_augmentation import get_augmentation_parameters
+from src.utils.batch_augmentation import augment_batch
+from src.utils.batch_augmentation import augment_batch_tf
+from src.utils.sequences import ImageSequence
+from src.utils.sequences import get_face_margin
+from src.utils.tf_data_generators import AUTOTUNE
+from src.utils.tf_data_generators import TFRECORD_BUFFER
+from src.utils.tf_data_generators import decode_image_bytes
+from src.utils.tf_data_generators import decode_face_bytes
+from src.utils.tf_data_generators import parse_tfrecord_example
+from src.benchmarks.jpeg_decoding import create_synthetic_jpegs
+
+"""
+Input pipeline throughput of get_generator/ get_cluster_generator without a
+model attached: images per second, cpu utilisation of the process and its
+worker processes, and the latency per batch of the stages of each backend,
+timed on the backend's own functions: read, decode, augment and collate of
+the tf_data and tfrecord maps, load (decode, cache or memmap read, array
+slicing), augment and collate of the keras iterators and ImageSequences.
+
+-d takes a dataset configuration (blob, cifar10, ...) or "synthetic", which
+generates a csv dataset of jpegs in a temporary directory so that the
+results are reproducible on any machine. With -b several input pipelines
+are compared on the same dataset (synthetic builds the tfrecord and memmap
+stores itself).
+
+run: python -m src.benchmarks.input_pipeline -d blob -m resnet50 -c jannik
+run: python -m src.benchmarks.input_pipeline -d synthetic -m resnet50 -c jannik -b keras tf_data cache memmap tfrecord
+"""
+
+synthetic_class_names = ['Anger', 'Happy', 'Neutral', 'Sad']
+
+
+def create_synthetic_dataset(path: str, number: int):
+    """ 640x480 jpegs, a csv per split and the dataset parameters """
+    rng = np.random.RandomState(0)
+    for split in ['training', 'validation']:
+        directory = os.path.join(path, split)
+        os.mkdir(directory)
+        create_synthetic_jpegs(directory, number, width=640, height=480)
+        dataframe = pd.DataFrame({
+            'subDirectory_filePath': ['img_{}.jpg'.format(i)
+                                      for i in range(number)],
+            'face_x': 160., 'face_y': 100., 'face_width': 320.,
+            'face_height': 300.,
+            'expression': rng.choice(synthetic_class_names, number)})
+        dataframe.to_csv(os.path.join(path, split + '.csv'), index=False)
+
+    return {'dataset_name': 'synthetic',
+            'num_classes': len(synthetic_class_names),
+            'class_names': synthetic_class_names,
+            'labels_type': 'csv',
+            'csv_training_file': 'training.csv',
+            'csv_validation_file': 'validation.csv',
+            'training_directory': 'training',
+            'validation_directory': 'validation',
+            'tfrecord_training_directory': 'tfrecords_training',
+            'tfrecord_validation_directory': 'tfrecords_validation',
+            'image_store_training_directory': 'store_training',
+            'image_store_validation_directory': 'store_validation',
+            'image_cache_directory': 'cache',
+            'image_cache_size_gb': 1,
+            'mean_RGB': [0.5, 0.5, 0.5],
+            'std_RGB': [0.25, 0.25, 0.25],
+            'class_label': 'expression',
+            'box_labels': ['face_x', 'face_y', 'face_width', 'face_height'],
+            'data_augmentation': 'resnetv2_augmentation',
+            'input_pipeline': 'keras'}
+
+
+def prepare_pipeline(input_pipeline: str, path: str, image_size: int):
+    """ build the converted stores the synthetic dataset needs """
+    if input_pipeline == 'tfrecord':
+        from src.process_affectnet.create_tfrecords import create_tfrecords
+        for split in ['training', 'validation']:
+            if not os.path.exists(os.path.join(path, 'tfrecords_' + split)):
+                create_tfrecords(path + '/', split + '.csv', split,
+                                 'tfrecords_' + split, 4)
+    elif input_pipeline == 'memmap':
+        from src.process_affectnet.create_image_store import create_image_store
+        for split in ['training', 'validation']:
+            if not os.path.exists(os.path.join(path, 'store_' + split)):
+                create_image_store(path + '/', split + '.csv', split,
+                                   'store_' + split, image_size)
+
+
+def batch_iterator(generator):
+    if isinstance(generator, tf.data.Dataset):
+        return iter(generator.repeat())
+    if hasattr(generator, '__next__'):
+        return generator
+    # keras Sequence
+    return (generator[i % len(generator)] for i in itertools.count())
+
+
+def live_children_cpu_time():
+    """
+    user + system seconds of the running descendants of this process (the
+    ProcessLoader workers), read from /proc as RUSAGE_CHILDREN only counts
+    the children that exited and were waited for
+    """
+    if not os.path.isdir('/proc'):
+        return 0.
+    clock_ticks = os.sysconf('SC_CLK_TCK')
+    parents, times = {}, {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as stat_file:
+                stat = stat_file.read()
+        except OSError:
+            # the process exited meanwhile
+            continue
+        # the command name is in parentheses and may contain spaces,
+        # the fields after it start with the state (field 3)
+        fields = stat[stat.rindex(')') + 2:].split()
+        parents[int(entry)] = int(fields[1])
+        times[int(entry)] = (int(fields[11]) + int(fields[12])) / clock_ticks
+
+    total = 0.
+    descendants = [os.getpid()]
+    while descendants:
+        parent = descendants.pop()
+        for pid, ppid in parents.items():
+            if ppid == parent:
+                total += times[pid]
+                descendants.append(pid)
+    return total
+
+
+def cpu_time():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return self_usage.ru_utime + self_usage.ru_stime + \
+        children_usage.ru_utime + children_usage.ru_stime + \
+        live_children_cpu_time()
+
+
+def measure_throughput(generator, number_of_batches: int, warmup: int = 2):
+    iterator = batch_iterator(generator)
+    for _ in range(warmup):
+        next(iterator)
+
+    images = 0
+    start_cpu = cpu_time()
+    start = time.perf_counter()
+    for _ in range(number_of_batches):
+        batch = next(iterator)
+        x = batch[0]
+        # cluster generator: [images, labels]
+        if isinstance(x, (list, tuple)):
+            x = x[0]
+        images += len(x)
+    wall = time.perf_counter() - start
+    cpu = cpu_time() - start_cpu
+
+    return {'images_per_second': images / wall,
+            'batch_latency_ms': 1000 * wall / number_of_batches,
+            'cpu_utilisation': cpu / wall}
+
+
+def list_image_files(dataset_parameters, computer_parameters,
+                     number_of_images: int):
+    """
+    file paths and face boxes (zeros without a face margin) of the first
+    training images of a csv dataset, as get_csv_dataset reads them
+    """
+    directory = os.path.join(computer_parameters['dataset_path'],
+                             dataset_parameters['training_directory'])
+    dataframe = pd.read_csv(os.path.join(
+        computer_parameters['dataset_path'],
+        dataset_parameters['csv_training_file']), nrows=number_of_images)
+    file_paths = [os.path.join(directory, f) for f
+                  in dataframe['subDirectory_filePath']]
+    if get_face_margin(dataset_parameters) is not None:
+        boxes = dataframe[dataset_parameters['box_labels']].values \
+            .astype('float32')
+    else:
+        boxes = np.zeros((len(file_paths), 4), dtype='float32')
+    return file_paths, boxes
+
+
+def stage_batches(generator, number_of_batches: int, batch_size: int):
+    """ index arrays of the first batches the generator serves """
+    if isinstance(generator, ClassBalancedSampler):
+        return generator.batches[:number_of_batches]
+    number_of_samples = len(generator.classes) if hasattr(generator, 'classes') \
+        else len(generator.x)
+    return [np.arange(start, min(start + batch_size, number_of_samples))
+            for start in range(0, number_of_samples, batch_size)
+            ][:number_of_batches]
+
+
+def sequence_stages(sequence, batch_indices):
+    """
+    load (cache read or decode, memmap read), augment and collate seconds of
+    ImageSequence.get_batch
+    """
+    stages = {'load': 0., 'augment': 0., 'collate': 0.}
+    for batch_index in batch_indices:
+        start = time.perf_counter()
+        images = sequence.load_images(batch_index).astype('float32')
+        stages['load'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        if sequence.augmentation is not None:
+            images = augment_batch(images, sequence.augmentation)
+        stages['augment'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        tf.keras.utils.to_categorical(sequence.classes[batch_index],
+                                      sequence.num_classes)
+        sequence.preprocess_fn(images)
+        stages['collate'] += time.perf_counter() - start
+    return stages
+
+
+def iterator_stages(iterator, batch_indices):
+    """
+    load (read and decode of the files, slicing of the in-memory arrays),
+    augment and collate seconds of _get_batches_of_transformed_samples of a
+    keras iterator
+    """
+    image_data_generator = iterator.image_data_generator
+    stages = {'load': 0., 'augment': 0., 'collate': 0.}
+    for batch_index in batch_indices:
+        start = time.perf_counter()
+        if hasattr(iterator, 'filepaths'):
+            filepaths = iterator.filepaths
+            images = []
+            for j in batch_index:
+                image = tf.keras.utils.load_img(
+                    filepaths[j],
+                    color_mode=iterator.color_mode,
+                    target_size=iterator.target_size,
+                    interpolation=iterator.interpolation,
+                    keep_aspect_ratio=getattr(iterator, 'keep_aspect_ratio',
+                                              False))
+                images.append(tf.keras.utils.img_to_array(
+                    image, data_format=iterator.data_format))
+                image.close()
+        else:
+            # NumpyArrayIterator of cifar10 and blob
+            images = list(np.asarray(iterator.x[batch_index],
+                                     dtype=iterator.dtype))
+        stages['load'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        if image_data_generator:
+            images = [image_data_generator.apply_transform(
+                image, image_data_generator.get_random_transform(image.shape))
+                for image in images]
+        stages['augment'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        if image_data_generator:
+            images = [image_data_generator.standardize(image)
+                      for image in images]
+        np.stack(images)
+        if hasattr(iterator, 'filepaths'):
+            tf.keras.utils.to_categorical(np.asarray(iterator.classes)[batch_index],
+                                          len(iterator.class_indices))
+        else:
+            iterator.y[batch_index]
+        stages['collate'] += time.perf_counter() - start
+    return stages
+
+
+def tf_data_stages(input_pipeline: str, dataset_parameters, model_parameters,
+                   computer_parameters, number_of_batches: int):
+    """
+    read, decode, augment and collate seconds per batch of the functions the
+    tf_data and tfrecord datasets map, each stage a separate pass mapped as
+    the backend maps it
+    """
+    height = model_parameters['image_height']
+    width = model_parameters['image_width']
+    batch_size = model_parameters['batch_size']
+    num_classes = dataset_parameters['num_classes']
+    face_margin = get_face_margin(dataset_parameters)
+
+    def decode(image, box):
+        if face_margin is not None:
+            return decode_face_bytes(image, box, face_margin, height, width)
+        return decode_image_bytes(image, height, width)
+
+    def decode_example(serialized_example):
+        example = parse_tfrecord_example(serialized_example)
+        return decode(example['image'], example['box']), \
+            tf.cast(example['label'], tf.int32)
+
+    def run(dataset):
+        """ seconds of a pass over the batches of a dataset and the batches """
+        start = time.perf_counter()
+        batches = list(dataset.batch(batch_size))
+        return time.perf_counter() - start, batches
+
+    stages = {}
+    if input_pipeline == 'tfrecord':
+        files = sorted(tf.io.gfile.glob(os.path.join(
+            computer_parameters['dataset_path'],
+            dataset_parameters['tfrecord_training_directory'], '*.tfrecord')))
+        stages['read'], batches = run(
+            tf.data.TFRecordDataset(files, buffer_size=TFRECORD_BUFFER)
+            .take(number_of_batches * batch_size))
+        stages['decode'], batches = run(
+            tf.data.Dataset.from_tensor_slices(tf.concat(batches, axis=0))
+            .map(decode_example, num_parallel_calls=AUTOTUNE))
+    else:
+        file_paths, boxes = list_image_files(dataset_parameters,
+                                             computer_parameters,
+                                             number_of_batches * batch_size)
+        stages['read'], batches = run(
+            tf.data.Dataset.from_tensor_slices(file_paths)
+            .map(tf.io.read_file, num_parallel_calls=AUTOTUNE))
+        stages['decode'], batches = run(
+            tf.data.Dataset.from_tensor_slices((tf.concat(batches, axis=0),
+                                                boxes))
+            .map(lambda image, box: (decode(image, box), 0),
+                 num_parallel_calls=AUTOTUNE))
+
+    augmentation = get_augmentation_parameters(
+        get_data_generator(dataset_parameters, True))
+    preprocess_fn = get_preprocessing_function(dataset_parameters)
+
+    @tf.function
+    def augment(images):
+        images = tf.cast(images, tf.float32)
+        if augmentation is not None:
+            images = augment_batch_tf(images, augmentation)
+        return images
+
+    @tf.function
+    def collate(images, labels):
+        return preprocess_fn(images), tf.one_hot(labels, num_classes)
+
+    # traced once before the timing, as dataset.map does
+    collate(augment(batches[0][0]), batches[0][1])
+    stages['augment'] = stages['collate'] = 0.
+    for images, labels in batches:
+        start = time.perf_counter()
+        images = augment(images)
+        stages['augment'] += time.perf_counter() - start
+
+        start = time.perf_counter()
+        collate(images, labels)
+        stages['collate'] += time.perf_counter() - start
+
+    return {stage: value / len(batches) for stage, value in stages.items()}
+
+
+def measure_stages(generator, input_pipeline: str, dataset_parameters,
+                   model_parameters, computer_parameters,
+                   number_of_batches: int = 4):
+    """
+    Mean latency (ms) of each stage for one batch of the backend being
+    benchmarked, timed in this process on its own functions: the workers of
+    a ProcessLoader and the tf.data runtime run these stages in parallel.
+    For the cache the batches were served by the throughput run before, so
+    load is the steady state read of the cache.
+    """
+    batch_size = model_parameters['batch_size']
+
+    # the loader and the sampler only distribute the batches of the sequence
+    loader = getattr(generator, 'loader', None)
+    if loader is not None:
+        generator = loader.sequence
+    batch_indices = None
+    if isinstance(generator, ClassBalancedSampler):
+        batch_indices = stage_batches(generator, number_of_batches, batch_size)
+        generator = generator.sequence
+
+    if isinstance(generator, tf.data.Dataset):
+        return {stage: 1000 * value for stage, value in tf_data_stages(
+            input_pipeline, dataset_parameters, model_parameters,
+            computer_parameters, number_of_batches).items()}
+
+    if batch_indices is None:
+        batch_indices = stage_batches(generator, number_of_batches, batch_size)
+    if isinstance(generator, ImageSequence):
+        stages = sequence_stages(generator, batch_indices)
+    else:
+        stages = iterator_stages(generator, batch_indices)
+    return {stage: 1000 * value / len(batch_indices)
+            for stage, value in stages.items()}
+
+
+def benchmark(model_configuration: str,
+              dataset_configuration: str,
+              computer_configuration: str,
+              input_pipelines=None,
+              number_of_batches: int = 50,
+              cluster: bool = False,
+              synthetic_images: int = 512):
+    with open('src/configuration/model/{}.json'
+                      .format(model_configuration)) as json_file:
+        model_parameters = json.load(json_file)
+
+    with open('src/configuration/computer/{}.json'
+                      .format(computer_configuration)) as json_file:
+        computer_parameters = json.load(json_file)
+
+    temporary_directory = None
+    if dataset_configuration == 'synthetic':
+        temporary_directory = tempfile.TemporaryDirectory()
+        computer_parameters['dataset_path'] = temporary_directory.name
+        dataset_parameters = create_synthetic_dataset(temporary_directory.name,
+                                                      synthetic_images)
+    else:
+        with open('src/configuration/dataset/{}.json'
+                          .format(dataset_configuration)) as json_file:
+            dataset_parameters = json.load(json_file)
+
+    if not input_pipelines:
+        input_pipelines = [dataset_parameters.get('input_pipeline', 'keras')]
+
+    results = {}
+    for input_pipeline in input_pipelines:
+        parameters = dict(dataset_parameters, input_pipeline=input_pipeline)
+        if temporary_directory is not None:
+            prepare_pipeline(input_pipeline, temporary_directory.name,
+                             model_parameters['image_height'])
+
+        if cluster:
+            training_data, _ = get_cluster_generator(parameters,
+                                                     model_parameters,
+                                                     computer_parameters)
+        else:
+            training_data, _ = get_generator(parameters,
+                                             model_parameters,
+                                             computer_parameters)
+
+        results[input_pipeline] = measure_throughput(training_data,
+                                                     number_of_batches)
+        print('** {}: {:.1f} img/s, {:.1f} ms/batch, cpu {:.2f} cores **'.format(
+            input_pipeline,
+            results[input_pipeline]['images_per_second'],
+            results[input_pipeline]['batch_latency_ms'],
+            results[input_pipeline]['cpu_utilisation']))
+
+        if cluster:
+            # the cluster dataset only adds the dummy target to these batches
+            training_data, _ = get_generator(parameters,
+                                             model_parameters,
+                                             computer_parameters)
+        stages = measure_stages(training_data, input_pipeline, parameters,
+                                model_parameters, computer_parameters)
+        print('** {} stage latency per batch of {}: {} **'.format(
+            input_pipeline, model_parameters['batch_size'],
+            ', '.join('{} {:.1f} ms'.format(k, v) for k, v in stages.items())))
+        results[input_pipeline]['stages'] = stages
+
+    if temporary_directory is not None:
+        temporary_directory.cleanup()
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-m", "--model",
+                        help="select your model")
+    parser.add_argument("-d", "--dataset",
+                        help="select your dataset, or synthetic")
+    parser.add_argument("-c", "--computer",
+                        help="select your computer")
+    parser.add_argument("-b", "--backends", nargs='*', default=None,
+                        help="input pipelines to compare")
+    parser.add_argument("-n", "--number", type=int, default=50,
+                        help="number of batches to time")
+    parser.add_argument("--cluster", action='store_true',
+                        help="use get_cluster_generator")
+
+    args = parser.parse_args()
+
+    benchmark(args.model,
+              args.dataset,
+              args.computer,
+              args.backends,
+              args.number,
+              args.cluster)
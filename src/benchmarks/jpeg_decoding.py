@@ -0,0 +1,96 @@
+import os
+import time
+import tempfile
+from argparse import ArgumentParser
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from src.utils.sequences import load_image
+from src.utils.tf_data_generators import decode_image_bytes
+
+"""
+Compare full size jpeg decoding + resize against DCT scaled decoding + resize
+(PIL draft and tf decode_jpeg ratio) in images per second.
+Without a directory, synthetic 1024x768 jpegs are generated.
+
+run: python -m src.benchmarks.jpeg_decoding -s 224
+run: python -m src.benchmarks.jpeg_decoding -p /data/affectnet/validation -n 500 -s 224
+"""
+
+
+def create_synthetic_jpegs(directory: str, number: int,
+                           width: int = 1024, height: int = 768):
+    rng = np.random.RandomState(0)
+    for i in range(number):
+        # smooth random image so the jpeg size is realistic
+        image = rng.randint(0, 256, (height // 16, width // 16, 3), 'uint8')
+        image = Image.fromarray(image).resize((width, height), Image.BILINEAR)
+        image.save(os.path.join(directory, 'img_{}.jpg'.format(i)), quality=90)
+
+
+def pil_full(file_path: str, size: int):
+    image = Image.open(file_path).convert('RGB')
+    return np.asarray(image.resize((size, size), Image.NEAREST))
+
+
+def tf_full(image, size: int):
+    image = tf.io.decode_image(image, channels=3, expand_animations=False)
+    return tf.image.resize(image, (size, size), method='nearest')
+
+
+def images_per_second(function, inputs):
+    start = time.perf_counter()
+    for x in inputs:
+        function(x)
+    return len(inputs) / (time.perf_counter() - start)
+
+
+def benchmark(path: str, number: int, size: int):
+    temporary_directory = None
+    if path is None:
+        temporary_directory = tempfile.TemporaryDirectory()
+        path = temporary_directory.name
+        create_synthetic_jpegs(path, number)
+
+    file_paths = sorted(os.path.join(path, f) for f in os.listdir(path)
+                        if f.lower().endswith(('.jpg', '.jpeg')))[:number]
+    contents = [tf.constant(open(f, 'rb').read()) for f in file_paths]
+
+    tf_full_fn = tf.function(lambda x: tf_full(x, size))
+    tf_reduced_fn = tf.function(lambda x: decode_image_bytes(x, size, size))
+    # trace once before timing
+    tf_full_fn(contents[0])
+    tf_reduced_fn(contents[0])
+
+    results = {
+        'pil full decode': images_per_second(lambda f: pil_full(f, size),
+                                             file_paths),
+        'pil draft decode': images_per_second(lambda f: load_image(f, size, size),
+                                              file_paths),
+        'tf full decode': images_per_second(tf_full_fn, contents),
+        'tf ratio decode': images_per_second(tf_reduced_fn, contents),
+    }
+
+    print('** {} images, target size {} **'.format(len(file_paths), size))
+    for name, value in results.items():
+        print('{:<20} {:>10.1f} img/s'.format(name, value))
+
+    if temporary_directory is not None:
+        temporary_directory.cleanup()
+    return results
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--path", default=None,
+                        help="directory of jpegs, synthetic images if empty")
+    parser.add_argument("-n", "--number", type=int, default=200,
+                        help="number of images")
+    parser.add_argument("-s", "--size", type=int, default=224,
+                        help="target width and height")
+
+    args = parser.parse_args()
+
+    benchmark(args.path, args.number, args.size)
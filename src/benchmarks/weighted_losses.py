@@ -0,0 +1,155 @@
+import time
+from argparse import ArgumentParser
+
+import numpy as np
+import tensorflow as tf
+
+from src.model_functions.WeightedSoftmaxCluster import SparseWeightedSoftmaxLoss
+from src.model_functions.WeightedSoftmaxCluster import WeightedSoftmaxLoss2
+from src.model_functions.WeightedSoftmaxCluster import SparseWeightedSoftmaxLoss2
+from src.model_functions.WeightedSoftmaxCluster import WeightedClusterLoss
+
+"""
+Class weighted losses of src/model_functions/WeightedSoftmaxCluster.py
+(weights gathered by class id or broadcast) against their previous
+implementations (tf.repeat of the weights and of the log-sum-exp, one-hot
+(B,K)x(K,1) matmul), for K = 8 and 11 classes and batches up to 1024.
+
+For every loss and shape the table lists the number of graph ops (the
+kernels launched per call, Placeholder/Const/Identity/NoOp excluded), the
+bytes of their statically shaped outputs (the intermediate allocations) and
+the time per call in a tf.function. The new losses are measured as their
+per-sample call followed by the mean over the batch, the reduction the old
+ones did themselves; the sample_weight handling of the keras Loss.__call__
+is not counted. Both implementations, and the keras __call__ of the new
+loss, must give the same value.
+
+run: python -m src.benchmarks.weighted_losses -n 1000
+"""
+
+ignored_ops = {'Placeholder', 'Const', 'Identity', 'NoOp'}
+
+
+def old_sparse_softmax_loss(class_weights, num_classes, y_true, y_pred):
+    y_true = tf.cast(y_true, dtype=tf.uint8)
+    y_true = tf.one_hot(y_true, num_classes)
+    y_true = tf.squeeze(tf.cast(y_true, dtype='float32'))
+    batch_size = tf.cast(tf.shape(y_pred)[0], dtype=y_pred.dtype)
+
+    a = tf.reduce_max(y_pred, axis=1)
+    a = tf.repeat(tf.expand_dims(a, axis=1), num_classes, axis=1)
+    sum_log = tf.math.log(tf.reduce_sum(tf.exp(y_pred - a), axis=1))
+    sum_log = a + tf.repeat(tf.expand_dims(sum_log, axis=1), num_classes, axis=1)
+    loss = tf.multiply(y_true, y_pred - sum_log)
+
+    cw = tf.repeat(tf.expand_dims(class_weights, axis=0), tf.shape(y_pred)[0], axis=0)
+    return -tf.reduce_sum(tf.multiply(cw, loss)) / batch_size
+
+
+def old_softmax_loss2(class_weights, num_classes, y_true, y_pred):
+    loss = tf.keras.losses.categorical_crossentropy(y_true, y_pred, from_logits=True)
+    loss = tf.expand_dims(loss, axis=1)
+    batch_size = tf.cast(tf.shape(y_pred)[0], dtype=y_pred.dtype)
+    weights = tf.matmul(y_true, tf.expand_dims(class_weights, axis=1))
+    return tf.reduce_sum(tf.multiply(weights, loss)) / batch_size
+
+
+def old_sparse_softmax_loss2(class_weights, num_classes, y_true, y_pred):
+    loss = tf.keras.losses.sparse_categorical_crossentropy(y_true, y_pred, from_logits=True)
+    loss = tf.expand_dims(loss, axis=1)
+    y_true = tf.cast(y_true, dtype=tf.uint8)
+    y_true = tf.one_hot(y_true, num_classes)
+    y_true = tf.squeeze(tf.cast(y_true, dtype='float32'))
+    batch_size = tf.cast(tf.shape(y_pred)[0], dtype=y_pred.dtype)
+    weights = tf.matmul(y_true, tf.expand_dims(class_weights, axis=1))
+    return tf.reduce_sum(tf.multiply(weights, loss)) / batch_size
+
+
+def old_cluster_loss(class_weights, num_classes, y_true, y_pred):
+    cw = tf.repeat(tf.expand_dims(class_weights, axis=0), tf.shape(y_pred)[0], axis=0)
+    return .5 * tf.reduce_sum(tf.multiply(cw, y_pred))
+
+
+def graph_cost(concrete_function):
+    """ number of ops and bytes of their statically shaped outputs """
+    ops = [op for op in concrete_function.graph.get_operations()
+           if op.type not in ignored_ops]
+    allocated = 0
+    for op in ops:
+        for output in op.outputs:
+            if output.shape.is_fully_defined() and output.dtype.size:
+                allocated += output.shape.num_elements() * output.dtype.size
+    return len(ops), allocated
+
+
+def time_function(function, inputs, number: int):
+    function(*inputs)
+    start = time.perf_counter()
+    for _ in range(number):
+        function(*inputs)
+    return 1e6 * (time.perf_counter() - start) / number
+
+
+def benchmark(num_classes: int, batch_size: int, number: int, seed: int = 0):
+    rng = np.random.RandomState(seed)
+    class_weights = rng.uniform(0.5, 5., num_classes).astype('float32')
+    label_ids = rng.randint(0, num_classes, (batch_size, 1))
+    logits = tf.constant(rng.randn(batch_size, num_classes), dtype='float32')
+    one_hot = tf.one_hot(label_ids[:, 0], num_classes)
+    sparse = tf.constant(label_ids, dtype=tf.int8)
+    cluster = tf.constant(rng.rand(batch_size, 1), dtype='float32')
+    weights = tf.constant(class_weights)
+
+    cases = [('SparseWeightedSoftmaxLoss', old_sparse_softmax_loss,
+              SparseWeightedSoftmaxLoss(num_classes, class_weights, from_logits=True),
+              (sparse, logits)),
+             ('WeightedSoftmaxLoss2', old_softmax_loss2,
+              WeightedSoftmaxLoss2(num_classes, class_weights, from_logits=True),
+              (one_hot, logits)),
+             ('SparseWeightedSoftmaxLoss2', old_sparse_softmax_loss2,
+              SparseWeightedSoftmaxLoss2(num_classes, class_weights, from_logits=True),
+              (sparse, logits)),
+             ('WeightedClusterLoss', old_cluster_loss,
+              WeightedClusterLoss(class_weights),
+              (one_hot, cluster))]
+
+    print('** K {}, batch {} **'.format(num_classes, batch_size))
+    print('{:<28} {:>9} {:>9} {:>12} {:>12} {:>10} {:>10}'.format(
+        'loss', 'ops old', 'ops new', 'bytes old', 'bytes new', 'us old', 'us new'))
+    for name, old_loss, new_loss, inputs in cases:
+        old_function = tf.function(
+            lambda y_true, y_pred, f=old_loss: f(weights, num_classes, y_true, y_pred))
+        # mean over the batch as keras reduces without sample_weight
+        new_function = tf.function(
+            lambda y_true, y_pred, f=new_loss: tf.reduce_mean(f.call(y_true, y_pred)))
+
+        np.testing.assert_allclose(old_function(*inputs).numpy(),
+                                   new_function(*inputs).numpy(),
+                                   rtol=1e-5)
+        np.testing.assert_allclose(old_function(*inputs).numpy(),
+                                   new_loss(*inputs).numpy(),
+                                   rtol=1e-5)
+
+        old_ops, old_bytes = graph_cost(old_function.get_concrete_function(*inputs))
+        new_ops, new_bytes = graph_cost(new_function.get_concrete_function(*inputs))
+        print('{:<28} {:>9} {:>9} {:>12} {:>12} {:>10.1f} {:>10.1f}'.format(
+            name, old_ops, new_ops, old_bytes, new_bytes,
+            time_function(old_function, inputs, number),
+            time_function(new_function, inputs, number)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-k", "--classes", type=int, nargs='+', default=[8, 11],
+                        help="numbers of classes")
+    parser.add_argument("-b", "--batch_sizes", type=int, nargs='+',
+                        default=[32, 128, 512, 1024],
+                        help="batch sizes")
+    parser.add_argument("-n", "--number", type=int, default=1000,
+                        help="number of timed calls")
+
+    args = parser.parse_args()
+
+    for k in args.classes:
+        for b in args.batch_sizes:
+            benchmark(k, b, args.number)
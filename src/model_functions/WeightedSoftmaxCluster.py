@@ -22,12 +22,77 @@ class ClusterLayer(Layer):
         features = input_shape[0]
 
         # initialize cluster
+        # every replica applies the same all-reduced update, the first one
+        # is written to all the mirrors of a MirroredStrategy
         cluster_init = tf.constant_initializer(0)
         self.cluster = tf.Variable(name='clusters',
                                    initial_value=cluster_init(shape=(self.num_classes, features[-1]), dtype='float32'),
-                                   trainable=False)
+                                   trainable=False,
+                                   synchronization=tf.VariableSynchronization.ON_WRITE,
+                                   aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA)
         super(ClusterLayer, self).build(input_shape)
 
+    def call(self, x):
+        # split input
+        features = x[0]
+        labels = x[1]
+        labels = tf.cast(labels, dtype=features.dtype)
+
+        return self._cluster_loss(features,
+                                  tf.argmax(labels, axis=1, output_type=tf.int32))
+
+    def _cluster_loss(self, features, label_ids):
+        """
+        Loss and center update from per-class statistics: the denominators
+        only depend on the class, they come from the (K, K) center distance
+        matrix, and the update from the per-class sums of the features, so
+        no (batch, K, D) tensor is built
+        """
+        # ------------------- compute Loss --------------------
+        # squared distances between the centers, centered to limit the
+        # cancellation of the Gram matrix formulation
+        centers = self.cluster - tf.reduce_mean(self.cluster, axis=0, keepdims=True)
+        squared_norms = tf.reduce_sum(tf.square(centers), axis=1)
+        distances = tf.expand_dims(squared_norms, axis=1) + \
+            tf.expand_dims(squared_norms, axis=0) - \
+            2 * tf.matmul(centers, centers, transpose_b=True)
+        class_denom = tf.reduce_sum(tf.maximum(distances, 0.), axis=1) + self.alpha
+
+        # compute numerator
+        ci = tf.gather(self.cluster, label_ids, axis=0)
+        nume = tf.reduce_sum(tf.square(features - ci), axis=1)
+        denom = tf.gather(class_denom, label_ids)
+
+        loss = tf.expand_dims(nume / denom, axis=1)  # make sure to have a second dimensions
+
+        # ------------------- Update cluster --------------------
+        # sum_b w_k (x_b - c_k) / denom_k over the samples b of each class k
+        feature_sums = tf.math.unsorted_segment_sum(features, label_ids, self.num_classes)
+        counts = tf.math.unsorted_segment_sum(tf.ones_like(nume), label_ids, self.num_classes)
+
+        # sum the statistics of all replicas, so that every replica computes
+        # the update a single device would compute on the global batch
+        replica_context = tf.distribute.get_replica_context()
+        if replica_context is not None and replica_context.num_replicas_in_sync > 1:
+            feature_sums, counts = replica_context.all_reduce(
+                tf.distribute.ReduceOp.SUM, [feature_sums, counts])
+        scale = tf.cast(self.class_weight, features.dtype) / class_denom
+        weighted_delta_c = tf.expand_dims(scale, axis=1) * \
+            (feature_sums - tf.expand_dims(counts, axis=1) * self.cluster)
+
+        # update clusters
+        self.cluster.assign_sub(self.gamma * weighted_delta_c)
+
+        # return loss
+        return loss
+
+
+class DenseClusterLayer(ClusterLayer):
+    """
+    Original formulation of the ClusterLayer with (batch, K, D) tensors, kept
+    as reference for test_cluster_layer_equivalence.py
+    """
+
     def call(self, x):
         # split input
         features = x[0]
@@ -78,105 +143,39 @@ class ClusterLayer(Layer):
 
 
 # create Custom Cluster layer
-class SparseClusterLayer(Layer):
-    def __init__(self, num_classes, class_weight, alpha=1, gamma=1, **kwargs):
-        self.num_classes = num_classes
-        self.class_weight = class_weight
-        self.alpha = alpha
-        self.gamma = gamma
-        super(SparseClusterLayer, self).__init__(**kwargs)
-
-    def build(self, input_shape):
-        # split input
-        features = input_shape[0]
-
-        # initialize cluster
-        cluster_init = tf.constant_initializer(0)
-        self.cluster = tf.Variable(name='clusters',
-                                   initial_value=cluster_init(shape=(self.num_classes, features[-1]), dtype='float32'),
-                                   trainable=False)
-
-        super(SparseClusterLayer, self).build(input_shape)
+class SparseClusterLayer(ClusterLayer):
+    """
+    ClusterLayer taking the labels as integer class ids of shape (batch, 1),
+    the centers are gathered and updated with segment sums directly, without
+    any one-hot or (batch, 1, K, D) tensor
+    """
 
     def call(self, x):
         # split input
         features = x[0]
         labels = x[1]
-        features = tf.expand_dims(features, axis=1)
-
-        # ------------------- compute Loss --------------------
-        # compute numerator
-        ci = tf.gather(self.cluster, labels, axis=0)
-        nume = tf.pow(tf.norm(features - ci, axis=2), 2)
-
-        # compute denominator
-        cj = tf.reshape(self.cluster, [-1])  # flatten cj
-        cj = tf.expand_dims(cj, axis=0)  # add extra axis
-        cj = tf.repeat(tf.expand_dims(cj, axis=0), tf.shape(labels)[0], axis=0)  # expand and repeats
-        ci_tile = tf.tile(ci, [1, 1, self.num_classes])
-        denom = tf.pow(tf.norm(cj - ci_tile, axis=2), 2) + self.alpha
 
-        loss = nume / denom
-
-        # ------------------- Update cluster --------------------
-        # cast y_true to one hot
-        labels_one_hot = tf.cast(labels, dtype=tf.uint8)
-        labels_one_hot = tf.one_hot(labels_one_hot, self.num_classes)
-        labels_one_hot = tf.cast(labels_one_hot, dtype='float32')
-
-        # compute numerator
-        labels_tile = tf.repeat(tf.expand_dims(labels_one_hot, axis=3), tf.shape(features)[-1], axis=3)
-        cluster = tf.expand_dims(self.cluster, axis=0)
-        cj = tf.multiply(labels_tile, cluster)
-        xj = tf.repeat(tf.expand_dims(features, axis=2), self.num_classes, axis=2)
-        xj = tf.multiply(labels_tile, xj)
-        nume = xj - cj
-
-        # compute denominator
-        denom = tf.repeat(tf.expand_dims(denom, axis=2), self.num_classes, axis=2)
-        denom = tf.repeat(tf.expand_dims(denom, axis=3), tf.shape(features)[-1], axis=3)
-
-        # compute delta center and apply weights
-        delta_c = nume / denom
-        cw = tf.expand_dims(self.class_weight, axis=0)  # add extra axis
-        cw = tf.repeat(tf.expand_dims(cw, axis=0), tf.shape(labels)[0], axis=0)
-        cw = tf.multiply(labels_one_hot, cw)
-        cw = tf.repeat(tf.expand_dims(cw, axis=3), features.shape[1], axis=3)
-        weighted_delta_c = tf.multiply(cw, delta_c)
-        weighted_delta_c = tf.reduce_sum(weighted_delta_c, axis=0)
-
-        # update clusters
-        new_cluster = self.gamma * weighted_delta_c
-        new_cluster = tf.reshape(new_cluster, shape=tf.shape(self.cluster))
-        self.cluster.assign_sub(new_cluster)
-
-        # return loss
-        return loss
+        return self._cluster_loss(features,
+                                  tf.reshape(tf.cast(labels, tf.int32), [-1]))
 
 
 class SparseWeightedSoftmaxLoss(Loss):
     """
     Expect labels to be provided as integers.
+    The weight of every sample is gathered by its class id and the loss is
+    returned per sample, so that keras applies sample_weight and averages
+    over the batch.
     """
 
     def __init__(self, num_classes, class_weights, from_logits=False):
         super().__init__()
-        self.class_weights = class_weights
+        self.class_weights = tf.constant(class_weights, dtype='float32')
         self.num_classes = num_classes
         self.from_logits = from_logits
 
     def call(self, y_true, y_pred):
-        # print("[call] shape y_true", y_true.shape)
-        # cast y_true to one hot
-        y_true = tf.cast(y_true, dtype=tf.uint8)
-        y_true = tf.one_hot(y_true, self.num_classes)
-        y_true = tf.cast(y_true, dtype='float32')
-        y_true = tf.squeeze(y_true)
-        # print("shape y_true_one_hot", y_true.shape)
-
-        # get batch size
-        batch_size = tf.shape(y_pred)[0]
-        batch_size = tf.cast(batch_size, dtype=y_pred.dtype)
+        # class ids of shape (batch,)
+        y_true = tf.reshape(tf.cast(y_true, dtype=tf.int32), [-1])
 
         # get softmax loss
         if self.from_logits:
@@ -184,109 +183,95 @@ class SparseWeightedSoftmaxLoss(Loss):
         else:
             loss = self._softmax_loss(y_true, y_pred)
 
-        # apply class weights and compute the sum
-        cw = tf.repeat(tf.expand_dims(self.class_weights, axis=0), tf.shape(y_pred)[0], axis=0)
-        return -tf.reduce_sum(tf.multiply(cw, loss)) / batch_size
+        # apply class weights
+        return -tf.gather(tf.cast(self.class_weights, y_pred.dtype), y_true) * loss
 
     def _softmax_loss_with_logits(self, y_true, y_pred):
         """ the function is equal to the CategoricalCrossEntropy """
-        # compute a to apply log sum exp trick
-        a = tf.reduce_max(y_pred, axis=1)
-        a = tf.repeat(tf.expand_dims(a, axis=1), self.num_classes, axis=1)
-
-        sum_log = tf.math.log(tf.reduce_sum(tf.exp(y_pred - a), axis=1))
-        sum_log = a + tf.repeat(tf.expand_dims(sum_log, axis=1), self.num_classes, axis=1)
-        return tf.multiply(y_true, y_pred - sum_log)
+        # log sum exp trick, broadcast over the classes
+        log_probabilities = y_pred - tf.reduce_logsumexp(y_pred, axis=1, keepdims=True)
+        return tf.gather(log_probabilities, y_true, axis=1, batch_dims=1)
 
     def _softmax_loss(self, y_true, y_pred):
-        y_pred = tf.math.maximum(1e-12, y_pred)
-        return tf.multiply(y_true, tf.math.log(y_pred))
+        y_pred = tf.gather(y_pred, y_true, axis=1, batch_dims=1)
+        return tf.math.log(tf.math.maximum(1e-12, y_pred))
 
 
 class WeightedSoftmaxLoss2(Loss):
+    """
+    Categorical cross entropy weighted by the class weights gathered by the
+    class id of the one-hot labels, returned per sample so that keras applies sample_weight and
+    averages over the batch
+    """
 
     def __init__(self, num_classes, class_weights, from_logits=False):
         super().__init__()
-        self.class_weights = tf.expand_dims(class_weights, axis=1)
+        self.class_weights = tf.constant(class_weights, dtype='float32')
         self.num_classes = num_classes
         self.from_logits = from_logits
 
-        if self.from_logits:
-            self.loss = tf.keras.losses.CategoricalCrossentropy(from_logits=True,
-                                                                      reduction=tf.keras.losses.Reduction.NONE)
-        else:
-            self.loss = tf.keras.losses.CategoricalCrossentropy(from_logits=False,
-                                                                      reduction=tf.keras.losses.Reduction.NONE)
-
     def call(self, y_true, y_pred):
         y_true = tf.cast(y_true, dtype=y_pred.dtype)
 
-        loss = self.loss(y_true, y_pred)
-        loss = tf.expand_dims(loss, axis=1)
+        loss = tf.keras.losses.categorical_crossentropy(y_true, y_pred,
+                                                        from_logits=self.from_logits)
 
-        # get batch_size
-        batch_size = tf.cast(tf.shape(y_pred)[0], dtype=y_pred.dtype)
-
-        # get batch weights
-        weights = tf.matmul(y_true, self.class_weights)
+        # get batch weights, gathered by the class id of the one-hot labels
+        weights = tf.gather(tf.cast(self.class_weights, y_pred.dtype),
+                            tf.argmax(y_true, axis=-1, output_type=tf.int32))
 
         # compute weighted loss
-        weighted_loss = tf.multiply(weights, loss)
-
-        red_loss = tf.reduce_sum(weighted_loss)
-
-        return red_loss / batch_size
+        return weights * loss
 
 
 class SparseWeightedSoftmaxLoss2(Loss):
+    """
+    Sparse categorical cross entropy weighted by the class weights gathered
+    by class id, returned per sample so that keras applies sample_weight and
+    averages over the batch
+    """
 
     def __init__(self, num_classes, class_weights, from_logits=False):
         super().__init__()
-        self.class_weights = tf.expand_dims(class_weights, axis=1)
+        self.class_weights = tf.constant(class_weights, dtype='float32')
         self.num_classes = num_classes
         self.from_logits = from_logits
 
-        if self.from_logits:
-            self.loss = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=True,
-                                                                      reduction=tf.keras.losses.Reduction.NONE)
-        else:
-            self.loss = tf.keras.losses.SparseCategoricalCrossentropy(from_logits=False,
-                                                                      reduction=tf.keras.losses.Reduction.NONE)
-
     def call(self, y_true, y_pred):
-        loss = self.loss(y_true, y_pred)
-        loss = tf.expand_dims(loss, axis=1)
-
-        # cast y_true to one hot
-        y_true = tf.cast(y_true, dtype=tf.uint8)
-        y_true = tf.one_hot(y_true, self.num_classes)
-        y_true = tf.cast(y_true, dtype='float32')
-        y_true = tf.squeeze(y_true)
+        # class ids of shape (batch,)
+        y_true = tf.reshape(tf.cast(y_true, dtype=tf.int32), [-1])
 
-        # get batch_size
-        batch_size = tf.cast(tf.shape(y_pred)[0], dtype=y_pred.dtype)
+        loss = tf.keras.losses.sparse_categorical_crossentropy(y_true, y_pred,
+                                                               from_logits=self.from_logits)
 
         # get batch weights
-        weights = tf.matmul(y_true, self.class_weights)
+        weights = tf.gather(tf.cast(self.class_weights, y_pred.dtype), y_true)
 
         # compute weighted loss
-        weighted_loss = tf.multiply(weights, loss)
-
-        red_loss = tf.reduce_sum(weighted_loss)
-
-        return red_loss / batch_size
+        return weights * loss
 
 
 class WeightedClusterLoss(Loss):
+    """
+    0.5 * lambda * sum(class_weights) * cluster loss, summed over the batch.
+    Returned per sample (multiplied by the batch size, as keras averages
+    over the batch) so that keras applies sample_weight.
+    """
+
     def __init__(self, class_weights, _lambda=1):
         super().__init__()
         self.class_weights = class_weights
         self._lambda = _lambda
+        self.total_weight = tf.reduce_sum(tf.constant(class_weights, dtype='float32'))
 
     def call(self, y_true, y_pred):
-        # apply class weights and compute the sum
-        cw = tf.repeat(tf.expand_dims(self.class_weights, axis=0), tf.shape(y_pred)[0], axis=0)
-        return .5 * self._lambda * tf.reduce_sum(tf.multiply(cw, y_pred))
+        batch_size = tf.cast(tf.shape(y_pred)[0], dtype=y_pred.dtype)
+        scale = .5 * self._lambda * batch_size
+        if y_pred.shape[-1] == 1:
+            # (batch, 1) loss of the ClusterLayer: every weight applies to it
+            return scale * tf.cast(self.total_weight, y_pred.dtype) * y_pred[:, 0]
+        # one column per class: each column gets its class weight
+        return scale * tf.reduce_sum(y_pred * tf.cast(self.class_weights, y_pred.dtype), axis=-1)
 
 
 import tensorflow.keras.backend as K
@@ -4,10 +4,11 @@ from sklearn.metrics import classification_report
 from argparse import ArgumentParser
 import tensorflow as tf
 import numpy as np
-import cv2
+from PIL import Image
 
 from src.utils.model_utility import *
 from src.utils.generators import *
+from src.utils.sequences import load_image
 
 
 def predict_model(model_configuration: str,
@@ -39,9 +40,8 @@ def predict_model(model_configuration: str,
 
     data = np.zeros((len(file_list), 224, 224, 3))
     for f, file in enumerate(file_list):
-        im = cv2.imread(os.path.join(data_path, file))
-        im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
-        im = cv2.resize(im, (224, 224))
+        im = load_image(os.path.join(data_path, file), 224, 224,
+                        resample=Image.BILINEAR)
 
         data[f] = im
     print("shape data", np.shape(data))
@@ -0,0 +1,160 @@
+import time
+import numpy as np
+import tensorflow as tf
+
+from src.model_functions.WeightedSoftmaxCluster import ClusterLayer
+from src.model_functions.WeightedSoftmaxCluster import DenseClusterLayer
+from src.model_functions.WeightedSoftmaxCluster import SparseClusterLayer
+
+"""
+Numerical equivalence of the ClusterLayer (per-class statistics, O(B*D + K*D)
+memory) with the original DenseClusterLayer ((batch, K, D) tensors): loss
+and centers after several updates, eagerly and in a tf.function, followed by
+the step time of both layers. The SparseClusterLayer, fed with int8 class ids,
+is compared the same way. Finally a ClusterLayer under a MirroredStrategy over
+two logical CPUs must keep the same centers on both replicas as a single
+device ClusterLayer fed with the global batch.
+
+run: python -m src.model_functions.test_cluster_layer_equivalence
+"""
+
+
+def configure_logical_cpus(number: int = 2):
+    """
+    Split the CPU into logical devices for the MirroredStrategy. Only
+    possible before tf is initialised, i.e. at import (also when pytest
+    collects this file), return the logical CPU names.
+    """
+    cpus = tf.config.list_physical_devices('CPU')
+    try:
+        tf.config.set_logical_device_configuration(
+            cpus[0], [tf.config.LogicalDeviceConfiguration()] * number)
+    except RuntimeError:
+        # tf was already initialised, e.g. by another test module
+        pass
+    return [device.name for device in tf.config.list_logical_devices('CPU')]
+
+
+logical_cpus = configure_logical_cpus()
+
+
+def build_layers(num_classes, feature_dim, class_weights, alpha, gamma,
+                 initial_clusters,
+                 layer_classes=(ClusterLayer, DenseClusterLayer)):
+    layers = []
+    for layer_class in layer_classes:
+        layer = layer_class(num_classes=num_classes,
+                            class_weight=class_weights,
+                            alpha=alpha,
+                            gamma=gamma)
+        layer.build([tf.TensorShape((None, feature_dim)),
+                     tf.TensorShape((None, num_classes))])
+        layer.cluster.assign(initial_clusters)
+        layers.append(layer)
+    return layers
+
+
+def test_equivalence(batch_size=64, num_classes=8, feature_dim=512,
+                     steps=5, use_function=False, seed=0, sparse=False):
+    rng = np.random.RandomState(seed)
+    class_weights = tf.constant(rng.uniform(0.5, 5., num_classes),
+                                dtype='float32')
+    initial_clusters = rng.randn(num_classes, feature_dim).astype('float32')
+    layer_classes = (SparseClusterLayer, DenseClusterLayer) if sparse \
+        else (ClusterLayer, DenseClusterLayer)
+    layers = build_layers(num_classes, feature_dim, class_weights, 1., 0.01,
+                          initial_clusters, layer_classes)
+    calls = [tf.function(layer) if use_function else layer for layer in layers]
+
+    for step in range(steps):
+        features = tf.constant(rng.randn(batch_size, feature_dim),
+                               dtype='float32')
+        label_ids = rng.randint(0, num_classes, (batch_size, 1))
+        labels = tf.one_hot(label_ids[:, 0], num_classes)
+
+        if sparse:
+            loss = calls[0]([features, tf.constant(label_ids, dtype=tf.int8)])
+        else:
+            loss = calls[0]([features, labels])
+        dense_loss = calls[1]([features, labels])
+        np.testing.assert_allclose(loss.numpy(), dense_loss.numpy(),
+                                   rtol=1e-4, atol=1e-6)
+        np.testing.assert_allclose(layers[0].cluster.numpy(),
+                                   layers[1].cluster.numpy(),
+                                   rtol=1e-4, atol=1e-5)
+
+    print('** equivalent: batch {}, K {}, D {}, {} steps, tf.function {}, '
+          'sparse {} **'.format(batch_size, num_classes, feature_dim, steps,
+                                use_function, sparse))
+
+
+def test_mirrored(batch_size=64, num_classes=8, feature_dim=32, steps=5,
+                  seed=0):
+    if len(logical_cpus) < 2:
+        print('** test_mirrored skipped: tf was initialised with {} logical '
+              'CPU **'.format(len(logical_cpus)))
+        return
+    strategy = tf.distribute.MirroredStrategy(logical_cpus[:2])
+    rng = np.random.RandomState(seed)
+    class_weights = rng.uniform(0.5, 5., num_classes).astype('float32')
+    initial_clusters = rng.randn(num_classes, feature_dim).astype('float32')
+
+    with strategy.scope():
+        mirrored = build_layers(num_classes, feature_dim, class_weights, 1.,
+                                0.01, initial_clusters, (ClusterLayer,))[0]
+    single = build_layers(num_classes, feature_dim, class_weights, 1., 0.01,
+                          initial_clusters, (ClusterLayer,))[0]
+
+    @tf.function
+    def distributed_step(inputs):
+        return strategy.run(mirrored, args=(list(inputs),))
+
+    for step in range(steps):
+        features = rng.randn(batch_size, feature_dim).astype('float32')
+        labels = np.eye(num_classes, dtype='float32')[
+            rng.randint(0, num_classes, batch_size)]
+        dataset = tf.data.Dataset.from_tensor_slices((features, labels)) \
+            .batch(batch_size)
+        for inputs in strategy.experimental_distribute_dataset(dataset):
+            distributed_step(inputs)
+        single([tf.constant(features), tf.constant(labels)])
+
+        replicas = [v.numpy() for v in
+                    strategy.experimental_local_results(mirrored.cluster)]
+        np.testing.assert_array_equal(replicas[0], replicas[1])
+        np.testing.assert_allclose(replicas[0], single.cluster.numpy(),
+                                   rtol=1e-4, atol=1e-5)
+
+    print('** mirrored centers equal the single device centers: batch {}, '
+          '{} steps **'.format(batch_size, steps))
+
+
+def time_layers(batch_size=256, num_classes=8, feature_dim=512, steps=50):
+    rng = np.random.RandomState(0)
+    layers = build_layers(num_classes, feature_dim, [1.] * num_classes, 1.,
+                          0.01, rng.randn(num_classes, feature_dim)
+                          .astype('float32'))
+    features = tf.constant(rng.randn(batch_size, feature_dim), dtype='float32')
+    labels = tf.one_hot(rng.randint(0, num_classes, batch_size), num_classes)
+
+    for layer in layers:
+        call = tf.function(layer)
+        call([features, labels])
+        start = time.perf_counter()
+        for _ in range(steps):
+            call([features, labels])
+        print('{:<20} {:>8.3f} ms/step'.format(
+            layer.__class__.__name__,
+            1000 * (time.perf_counter() - start) / steps))
+
+
+if __name__ == '__main__':
+    test_equivalence()
+    test_equivalence(use_function=True)
+    test_equivalence(batch_size=3, num_classes=11, feature_dim=16)
+    # classes missing from the batch keep their centers
+    test_equivalence(batch_size=2, num_classes=8, feature_dim=64)
+    test_equivalence(sparse=True)
+    test_equivalence(use_function=True, sparse=True)
+    test_mirrored()
+    time_layers()
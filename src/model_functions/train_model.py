@@ -70,7 +70,12 @@ def train_model(model_configuration: str,
 
     print('** classes indices: **', training_data.class_indices)
     class_weights = None
-    if model_parameters['class_weights']:
+    if model_parameters['class_weights'] and \
+            dataset_parameters.get('class_weights'):
+        # computed by src.utils.dataset_statistics
+        class_weights = dict(enumerate(dataset_parameters['class_weights']))
+        print('** loaded class weights **', class_weights)
+    elif model_parameters['class_weights']:
         class_weights = {
             0: float(134414 / 24882),
             1: float(134414 / 3750),
@@ -83,10 +88,16 @@ def train_model(model_configuration: str,
         }
         print('** loaded class weights **', class_weights)
 
+    # the tf.data pipelines (tf_data, tfrecord, process loader) are finite:
+    # validate on one full pass, a fixed number of steps would run out of
+    # data in the first epoch and keras would skip the later validations
+    validation_steps = None if isinstance(validation_data, tf.data.Dataset) \
+        else 128
+
     model.fit(training_data,
               epochs=model_parameters['number_epochs'],
               validation_data=validation_data,
-              validation_steps=128,
+              validation_steps=validation_steps,
               callbacks=callbacks_list,
               class_weight=class_weights,
               workers=12)
@@ -102,28 +102,20 @@ def train_model(model_configuration: str,
     #     print('** loaded class weights **', class_weights)
 
     print(model.summary())
-    # test generator
-    # next(training_data)
+    # the cluster datasets are finite and prefetched, one pass is one epoch,
+    # also for the validation (a fixed number of validation_steps would run
+    # out of data and keras would skip the validation of the later epochs)
     model.fit(training_data,
               epochs=model_parameters['number_epochs'],
               validation_data=validation_data,
-              validation_steps=128,
               callbacks=callbacks_list,
-              steps_per_epoch=dataset_parameters['num_train_images']/model_parameters['batch_size'],
-              # steps_per_epoch=5000/model_parameters['batch_size'],
               # class_weight=class_weights,
-              workers=1,
-              # workers=12,
-              use_multiprocessing=False
               )
 
 
     save_metrics(history, metrics)
 
     evaluation = model.evaluate(validation_data,
-                                workers=1,
-                                use_multiprocessing=False,
-                                steps=dataset_parameters['num_val_images'] / model_parameters['batch_size'],
                                 verbose=1)
 
     print("evaluation", evaluation)
@@ -0,0 +1,198 @@
+"""
+Copy stage of the AffectNet preprocessing: copies the images listed in a csv
+from the sub-folders of Manually_Annotated_Images into one flat directory,
+on a thread pool as the copies are bound by I/O.
+
+Completed files are appended to a journal next to the destination directory
+(<destination>.journal, one file name per line), a restart skips them after
+a single existence check instead of copying them again. The journal of a
+destination directory that does not exist anymore is discarded. Files are
+written under a temporary name and renamed, so an interrupted copy never
+looks complete. At most a few tasks per thread are queued, so after an error
+the pool stops within a few files.
+
+mode:
+    copy: byte copy
+    hardlink: os.link, source and destination must share a file system
+    symlink: absolute symbolic link to the source
+    reflink: copy-on-write clone (btrfs, xfs), falls back to a byte copy
+    auto: hardlink, falls back to a byte copy across file systems
+
+run: python -m src.process_affectnet.copy_images -p /data/affectnet/ -f Manually_Annotated_file_lists/training.csv -o training -m hardlink
+"""
+import os
+import time
+import errno
+import fcntl
+import shutil
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+# linux ioctl of a copy-on-write clone, _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+journal_flush = 1000
+# queued transfers per thread
+queue_depth = 4
+
+
+def _reflink(source: str, destination: str):
+    with open(source, 'rb') as source_file, \
+            open(destination, 'wb') as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+
+
+def _transfer(source: str, destination: str, mode: str):
+    """ write destination through a temporary file, return the bytes copied """
+    temporary = destination + '.tmp'
+    if os.path.lexists(temporary):
+        os.remove(temporary)
+
+    if mode in ['hardlink', 'auto']:
+        try:
+            os.link(source, temporary)
+            os.replace(temporary, destination)
+            return 0
+        except OSError as error:
+            if mode == 'hardlink' or error.errno != errno.EXDEV:
+                raise
+    elif mode == 'symlink':
+        os.symlink(os.path.abspath(source), temporary)
+        os.replace(temporary, destination)
+        return 0
+    elif mode == 'reflink':
+        try:
+            _reflink(source, temporary)
+            os.replace(temporary, destination)
+            return 0
+        except OSError:
+            # file system without clones
+            if os.path.lexists(temporary):
+                os.remove(temporary)
+
+    shutil.copyfile(source, temporary)
+    os.replace(temporary, destination)
+    return os.stat(destination).st_size
+
+
+def get_journal_path(destination_directory: str):
+    return os.path.normpath(destination_directory) + '.journal'
+
+
+def read_journal(journal_path: str):
+    if not os.path.exists(journal_path):
+        return set()
+    with open(journal_path) as journal:
+        return set(journal.read().split('\n'))
+
+
+def copy_images(sources, destination_directory: str, workers: int = 32,
+                mode: str = 'copy', names=None):
+    """
+    Copy (or link) every source file into destination_directory, keeping its
+    file name or under the given names. Files in the journal of a previous
+    run that still exist are skipped.
+    """
+    if mode not in ['copy', 'hardlink', 'symlink', 'reflink', 'auto']:
+        raise ValueError('Copy mode does not exist', mode)
+
+    journal_path = get_journal_path(destination_directory)
+    if not os.path.exists(destination_directory):
+        # the journal of a deleted directory lists files that are gone
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
+        os.mkdir(destination_directory)
+
+    completed = read_journal(journal_path)
+    if names is None:
+        names = [os.path.basename(s) for s in sources]
+    # journaled files that were removed since are copied again
+    remaining = [(s, n) for s, n in zip(sources, names)
+                 if n not in completed or
+                 not os.path.lexists(os.path.join(destination_directory, n))]
+    sources = [s for s, _ in remaining]
+    names = [n for _, n in remaining]
+    print('** {} images already in the journal, {} to {} **'.format(
+        len(completed) - ('' in completed), len(sources), mode))
+
+    destinations = [os.path.join(destination_directory, n) for n in names]
+
+    copied_bytes = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            open(journal_path, 'a') as journal:
+        # bounded queue: an error stops the copy after the queued transfers
+        pending = deque()
+        for i in range(len(sources) + 1):
+            if i < len(sources):
+                pending.append((names[i], executor.submit(
+                    _transfer, sources[i], destinations[i], mode)))
+                if len(pending) < queue_depth * workers:
+                    continue
+            while pending and (i == len(sources) or
+                               len(pending) >= queue_depth * workers):
+                name, future = pending.popleft()
+                try:
+                    copied_bytes += future.result()
+                except BaseException:
+                    for _, queued in pending:
+                        queued.cancel()
+                    raise
+                journal.write(name + '\n')
+                done = i + 1 - len(pending) if i < len(sources) \
+                    else len(sources) - len(pending)
+                if done % journal_flush == 0:
+                    journal.flush()
+                if done % 10000 == 0:
+                    elapsed = time.perf_counter() - start
+                    print('processed images: {}, {:.0f} img/s, {:.1f} MB/s'
+                          .format(done, done / elapsed,
+                                  copied_bytes / elapsed / 1e6))
+
+    elapsed = time.perf_counter() - start
+    print('** {} images in {:.1f}s: {:.0f} img/s, {:.1f} MB/s copied **'.format(
+        len(sources), elapsed, len(sources) / max(elapsed, 1e-9),
+        copied_bytes / max(elapsed, 1e-9) / 1e6))
+    return len(sources)
+
+
+def copy_csv_images(path: str, file_name: str, output: str,
+                    start: int = 0, workers: int = 32, mode: str = 'copy'):
+    """ copy the images of the csv (rows from start on) into path + output """
+    dataframe = pd.read_csv(path + file_name,
+                            usecols=['subDirectory_filePath'])
+    sources = (path + 'Manually_Annotated_Images/' +
+               dataframe['subDirectory_filePath'].iloc[start:]).tolist()
+    return copy_images(sources, path + output, workers, mode)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--path",
+                        help="path to the affectnet directory")
+    parser.add_argument("-f", "--file",
+                        help="csv file with the sub-folder paths")
+    parser.add_argument("-o", "--output",
+                        help="name of the flat image directory")
+    parser.add_argument("-n", "--number", type=int, default=0,
+                        help="starting row")
+    parser.add_argument("-w", "--workers", type=int, default=32,
+                        help="number of threads")
+    parser.add_argument("-m", "--mode", default='copy',
+                        help="copy, hardlink, symlink, reflink or auto")
+
+    args = parser.parse_args()
+
+    print('Processing started at {}'.format(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ))
+
+    copy_csv_images(args.path, args.file, args.output, args.number,
+                    args.workers, args.mode)
+
+    print('Processing finished at {}'.format(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ))
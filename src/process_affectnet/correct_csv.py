@@ -1,8 +1,6 @@
-import os
 from argparse import ArgumentParser
 from datetime import datetime
 import pandas as pd
-import shutil
 
 
 def process_affectnet(path: str, new_path: str, file_name: str, new_name: str):
@@ -13,11 +11,9 @@ def process_affectnet(path: str, new_path: str, file_name: str, new_name: str):
 
     dataframe = pd.read_csv(path + file_name)
 
-    for index, image_path in enumerate(dataframe.loc[:,
-                                       'subDirectory_filePath']):
-
-        directory, image = image_path.split('/')
-        dataframe.loc[index, 'subDirectory_filePath'] = image
+    # remove the sub-folder of every path
+    dataframe['subDirectory_filePath'] = dataframe['subDirectory_filePath'] \
+        .str.split('/', n=1, expand=True)[1]
 
     dataframe.to_csv(new_path + new_name + "_modified.csv", index=False)
 
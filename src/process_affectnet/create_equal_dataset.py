@@ -1,13 +1,40 @@
+"""
+Create a class balanced subset of affectnet with at most number_of_images
+images per expression, either the first ones of the csv or a random sample.
+
+The subset csv is written once, the images are then linked (or copied) in
+parallel by src/process_affectnet/copy_images.py into <directory>_equal<n>.
+With --manifest_only nothing is copied: a compiled manifest of the subset
+csv is written over the original image directory, to train with
+"use_manifest": true, "csv_training_file": "training_equal<n>.csv" and
+"training_directory": "training".
+With --blob_store the subset csv points into the deduplicated blob store of
+src/process_affectnet/dedup_index.py and a manifest is compiled over it, to
+train with "training_directory": <store>.
+
+run: python -m src.process_affectnet.create_equal_dataset -p /data/affectnet/ -n 3000 -t 1 -m hardlink
+"""
 import os
 import shutil
 from argparse import ArgumentParser
 
 import pandas as pd
 
+from src.process_affectnet.copy_images import copy_images
+from src.process_affectnet.dedup_index import to_blob_paths
+from src.utils.manifest import compile_manifest
+from src.utils.manifest import get_class_names_path
+
 
 def create_equal_dataset(path: str,
                          number_of_images: int,
-                         train: bool):
+                         train: bool,
+                         random: bool = False,
+                         seed: int = 0,
+                         manifest_only: bool = False,
+                         mode: str = 'copy',
+                         blob_store: str = None,
+                         index_file: str = 'dedup_index.csv'):
     if train:
         file_name = 'training_modified_renamed.csv'
         directory = 'training'
@@ -15,78 +42,71 @@ def create_equal_dataset(path: str,
         file_name = 'validation_modified_renamed.csv'
         directory = 'validation'
 
-    # read the csv and create a new dataframe
+    # read the csv and select the rows of every expression at once
     dataframe = pd.read_csv(path + file_name)
-    new_dataframe = pd.DataFrame(columns=['subDirectory_filePath',
-                                          'expression'], index=None)
-
-    # create new directory for the equal affectnet
-    directory_new = path + directory + '_equal' + number_of_images
-    if not os.path.exists(directory_new):
-        os.mkdir(directory_new)
-
-    image_counter = {"Neutral": 0, "Happy": 0, "Sad": 0, "Surprise": 0,
-                     "Fear": 0, "Disgust": 0, "Anger": 0, "Contempt": 0,
-                     "None": 0, "Uncertain": 0, "Non-Face": 0}
-    counter = 0
-    # copy the limited amount of images from the old into the new directory
-    for index, row in enumerate(dataframe.iterrows()):
-        counter = 0
-        expression = dataframe.loc[index, 'expression']
-        if image_counter[expression] <= int(number_of_images):
-            image_name = dataframe.loc[index, 'subDirectory_filePath']
-            shutil.copyfile(path + directory + '/' + image_name,
-                            directory_new + '/' + image_name)
-            image_counter[expression] = image_counter[expression] + 1
-            new_dataframe = new_dataframe.append(
-                {'subDirectory_filePath': image_name, 'expression': expression},
-                ignore_index=True)
-            for x, y in image_counter.items():
-                counter = counter + y
-
-        if counter == int(number_of_images) * 11:
-            print('finished')
-            break
-
-        if index % 1000 == 0:
-            print('images: {}'.format(index))
-
-
-
-    print(
-        '** {} ** Neutral {} ** Happy {} ** Sad {} **Surprise {} ** Fear {} ** Disgust {} ** Anger {} **Contempt {} ** None {} **Uncertain {} **Non-Face {} **'.format(
-            counter,
-            image_counter["Neutral"],
-            image_counter["Happy"],
-            image_counter["Sad"],
-            image_counter["Surprise"],
-            image_counter["Fear"],
-            image_counter["Disgust"],
-            image_counter["Anger"],
-            image_counter["Contempt"],
-            image_counter["None"],
-            image_counter["Uncertain"],
-            image_counter["Non-Face"]))
-    if train:
-        new_dataframe.to_csv(path + "training_equal" + number_of_images +
-                             ".csv", index=False)
+    if random:
+        dataframe = dataframe.sample(frac=1, random_state=seed)
+    new_dataframe = dataframe.groupby('expression', sort=False) \
+        .head(number_of_images)
+    if random:
+        # back to the csv order, i.e. forward reads of the images
+        new_dataframe = new_dataframe.sort_index()
+
+    counts = new_dataframe['expression'].value_counts()
+    print('** {} ** {} **'.format(
+        len(new_dataframe),
+        ' ** '.join('{} {}'.format(k, v) for k, v in counts.items())))
+
+    new_file = '{}{}_equal{}.csv'.format(path, directory, number_of_images)
+    # the int8 codes of the subset keep the lookup table of the input csv
+    if os.path.exists(get_class_names_path(path + file_name)):
+        shutil.copyfile(get_class_names_path(path + file_name),
+                        get_class_names_path(new_file))
+
+    if blob_store is not None:
+        dedup_index = pd.read_csv(path + index_file)
+        new_dataframe = to_blob_paths(new_dataframe, dedup_index, directory)
+        new_dataframe.to_csv(new_file, index=False)
+        compile_manifest(new_file, path + blob_store, 'expression')
+        return
+
+    new_dataframe.to_csv(new_file, index=False)
+
+    if manifest_only:
+        compile_manifest(new_file, path + directory, 'expression')
     else:
-        new_dataframe.to_csv(path + "validation_equal" + number_of_images +
-                             ".csv", index=False)
+        copy_images((path + directory + '/' +
+                     new_dataframe['subDirectory_filePath']).tolist(),
+                    '{}{}_equal{}'.format(path, directory, number_of_images),
+                    mode=mode)
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument("-p", "--path",
                         help="path to the affectnet directory")
-    parser.add_argument("-n", "--number",
+    parser.add_argument("-n", "--number", type=int,
                         help="number of images")
     parser.add_argument("-t", "--train", type=bool,
                         help="include when creating a training directory")
+    parser.add_argument("-r", "--random", action='store_true',
+                        help="random images instead of the first ones")
+    parser.add_argument("-s", "--seed", type=int, default=0,
+                        help="seed of the random selection")
+    parser.add_argument("--manifest_only", action='store_true',
+                        help="write a manifest over the original images, no copies")
+    parser.add_argument("-m", "--mode", default='copy',
+                        help="copy, hardlink, reflink or auto")
+    parser.add_argument("-b", "--blob_store", default=None,
+                        help="write a manifest over this dedup blob store")
+    parser.add_argument("-i", "--index", default='dedup_index.csv',
+                        help="dedup index of the blob store")
 
     args = parser.parse_args()
     affectnet_path = args.path
     subset_size = args.number
     training_bool = args.train
 
-    create_equal_dataset(affectnet_path, subset_size, training_bool)
+    create_equal_dataset(affectnet_path, subset_size, training_bool,
+                         args.random, args.seed, args.manifest_only,
+                         args.mode, args.blob_store, args.index)
@@ -0,0 +1,125 @@
+"""
+Decode and resize every image of a csv once and write them into a contiguous
+uint8 N x H x W x 3 .npy file together with a label array.
+With a margin, the images are first cropped to their face box, so a smaller
+store size can be used.
+The store is read by get_generator with "input_pipeline": "memmap".
+
+run: python -m src.process_affectnet.create_image_store -p /data/affectnet/ -f training_modified_renamed.csv -d training -o store_training_224 -s 224
+run: python -m src.process_affectnet.create_image_store -p /data/affectnet/ -f training_modified_renamed.csv -d training -o faces_training_112 -s 112 -m 0.1
+"""
+import os
+import json
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+
+from src.utils.sequences import load_image
+from src.utils.manifest import box_labels
+from src.utils.manifest import read_csv_labels
+from src.utils.manifest import drop_quarantined
+
+chunk_size = 1024
+
+
+def write_chunk(images_path: str, start: int, directory: str, image_names,
+                size: int, boxes=None, margin: float = None):
+    # each worker maps the store itself and fills its own rows
+    images = np.load(images_path, mmap_mode='r+')
+    for i, image_name in enumerate(image_names):
+        images[start + i] = load_image(os.path.join(directory, image_name),
+                                       size, size,
+                                       box=None if boxes is None else boxes[i],
+                                       margin=margin)
+    images.flush()
+    return start + len(image_names)
+
+
+def create_image_store(path: str,
+                       file_name: str,
+                       directory: str,
+                       output: str,
+                       size: int,
+                       margin: float = None,
+                       class_label: str = 'expression',
+                       workers: int = 8):
+
+    print('Processing started at {}'.format(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ))
+
+    # same label indices as flow_from_dataframe, or the lookup table of a
+    # csv with int8 coded labels
+    dataframe, class_indices = read_csv_labels(path + file_name, class_label)
+    # the images flagged by fix_dataset/check_images.py do not decode
+    dataframe = drop_quarantined(dataframe, path + directory)
+    labels = dataframe[class_label].map(class_indices).values.astype('int32')
+    image_names = dataframe['subDirectory_filePath'].values
+    boxes = None
+    if margin is not None:
+        # crop each image to its face box
+        boxes = dataframe[box_labels].values.astype('float32')
+
+    output_directory = path + output
+    if not os.path.exists(output_directory):
+        os.mkdir(output_directory)
+
+    images_path = os.path.join(output_directory, 'images.npy')
+    images = np.lib.format.open_memmap(images_path, mode='w+', dtype='uint8',
+                                       shape=(len(dataframe), size, size, 3))
+    del images
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(write_chunk,
+                                   images_path,
+                                   start,
+                                   path + directory,
+                                   image_names[start:start + chunk_size],
+                                   size,
+                                   None if boxes is None
+                                   else boxes[start:start + chunk_size],
+                                   margin)
+                   for start in range(0, len(dataframe), chunk_size)]
+        for future in futures:
+            print('processed images: {}'.format(future.result()))
+
+    np.save(os.path.join(output_directory, 'labels.npy'), labels)
+    with open(os.path.join(output_directory, 'metadata.json'), 'w') as json_file:
+        json.dump({'class_indices': class_indices,
+                   'num_examples': len(dataframe),
+                   'image_size': size,
+                   'face_margin': margin}, json_file, indent=2)
+
+    print('Processing finished at {}'.format(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--path",
+                        help="path to the affectnet directory")
+    parser.add_argument("-f", "--file",
+                        help="csv file to convert")
+    parser.add_argument("-d", "--directory",
+                        help="image directory of the csv")
+    parser.add_argument("-o", "--output",
+                        help="name of the store directory")
+    parser.add_argument("-s", "--size", type=int, default=224,
+                        help="image width and height of the store")
+    parser.add_argument("-m", "--margin", type=float, default=None,
+                        help="crop the images to their face box with this margin")
+    parser.add_argument("-l", "--label", default='expression',
+                        help="label column")
+
+    args = parser.parse_args()
+
+    create_image_store(args.path,
+                       args.file,
+                       args.directory,
+                       args.output,
+                       args.size,
+                       args.margin,
+                       args.label)
@@ -0,0 +1,129 @@
+"""
+Pack a csv and its image directory into sharded TFRecord files, so that an
+epoch reads a few large files instead of ~290k small jpegs.
+Each record holds the encoded image bytes, the label index and the face box.
+The shards are read by get_generator with "input_pipeline": "tfrecord".
+
+run: python -m src.process_affectnet.create_tfrecords -p /data/affectnet/ -f training_modified_renamed.csv -d training -o tfrecords_training -n 64
+"""
+import os
+import json
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import tensorflow as tf
+
+from src.utils.manifest import box_labels
+from src.utils.manifest import read_csv_labels
+from src.utils.manifest import drop_quarantined
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def _float_feature(values):
+    return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+
+def write_shard(shard_path: str, directory: str, image_names, labels, boxes):
+    with tf.io.TFRecordWriter(shard_path) as writer:
+        for image_name, label, box in zip(image_names, labels, boxes):
+            with open(os.path.join(directory, image_name), 'rb') as file:
+                image = file.read()
+
+            example = tf.train.Example(features=tf.train.Features(feature={
+                'image': _bytes_feature(image),
+                'label': _int64_feature(int(label)),
+                'box': _float_feature(box),
+            }))
+            writer.write(example.SerializeToString())
+
+    print('** written {} **'.format(shard_path))
+
+
+def create_tfrecords(path: str,
+                     file_name: str,
+                     directory: str,
+                     output: str,
+                     number_of_shards: int,
+                     class_label: str = 'expression',
+                     workers: int = 8):
+
+    print('Processing started at {}'.format(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ))
+
+    # same label indices as flow_from_dataframe, or the lookup table of a
+    # csv with int8 coded labels
+    dataframe, class_indices = read_csv_labels(path + file_name, class_label)
+    # the images flagged by fix_dataset/check_images.py do not decode
+    dataframe = drop_quarantined(dataframe, path + directory)
+    labels = dataframe[class_label].map(class_indices).values.astype('int32')
+    image_names = dataframe['subDirectory_filePath'].values
+    if set(box_labels).issubset(dataframe.columns):
+        boxes = dataframe[box_labels].values.astype('float32')
+    else:
+        boxes = np.zeros((len(dataframe), 4), dtype='float32')
+
+    output_directory = path + output
+    if not os.path.exists(output_directory):
+        os.mkdir(output_directory)
+
+    # contiguous shards keep the csv order when read sequentially
+    bounds = np.linspace(0, len(dataframe), number_of_shards + 1).astype(int)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for shard in range(number_of_shards):
+            start, stop = bounds[shard], bounds[shard + 1]
+            shard_path = os.path.join(output_directory, '{:05d}-of-{:05d}.tfrecord'
+                                      .format(shard, number_of_shards))
+            futures.append(executor.submit(write_shard,
+                                           shard_path,
+                                           path + directory,
+                                           image_names[start:stop],
+                                           labels[start:stop],
+                                           boxes[start:stop]))
+        for future in futures:
+            future.result()
+
+    np.save(os.path.join(output_directory, 'labels.npy'), labels)
+    with open(os.path.join(output_directory, 'metadata.json'), 'w') as json_file:
+        json.dump({'class_indices': class_indices,
+                   'num_examples': len(dataframe),
+                   'num_shards': number_of_shards}, json_file, indent=2)
+
+    print('Processing finished at {}'.format(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--path",
+                        help="path to the affectnet directory")
+    parser.add_argument("-f", "--file",
+                        help="csv file to pack")
+    parser.add_argument("-d", "--directory",
+                        help="image directory of the csv")
+    parser.add_argument("-o", "--output",
+                        help="name of the tfrecord directory")
+    parser.add_argument("-n", "--number", type=int, default=64,
+                        help="number of shards")
+    parser.add_argument("-l", "--label", default='expression',
+                        help="label column")
+
+    args = parser.parse_args()
+
+    create_tfrecords(args.path,
+                     args.file,
+                     args.directory,
+                     args.output,
+                     args.number,
+                     args.label)
@@ -0,0 +1,222 @@
+"""
+Deduplication index of affectnet image directories (training, validation and
+the training_small*/ training_equal*/ categorical_* copies).
+
+Every image gets a content hash (sha1 of its bytes) and a 64 bit difference
+hash (dHash of a 9x8 grayscale thumbnail, decoded with draft) computed on a
+process pool. The index is saved as a csv and the report lists:
+    - exact duplicates (same content) and the disk space they take
+    - near duplicates (dHash Hamming distance <= threshold)
+    - cross directory leakage, e.g. training images found in validation,
+      written as pairs to <index>_leakage.csv
+
+With -b every distinct content is linked once into a flat blob store
+(<sha1><ext>). create_equal_dataset --blob_store then writes subsets as a
+csv + manifest over that store instead of copying the images.
+
+run: python -m src.process_affectnet.dedup_index -p /data/affectnet/ -d training validation -o dedup_index.csv
+run: python -m src.process_affectnet.dedup_index -p /data/affectnet/ -d training validation -o dedup_index.csv -b blob_store -m hardlink
+"""
+import os
+import hashlib
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from src.process_affectnet.copy_images import copy_images
+
+hash_size = 8
+# number of set bits of every byte
+popcount = np.unpackbits(np.arange(256, dtype='uint8')[:, None],
+                         axis=1).sum(axis=1)
+
+
+def difference_hash(image):
+    """ 64 bit dHash: sign of the horizontal gradients of a 9x8 thumbnail """
+    image.draft('L', (4 * (hash_size + 1), 4 * hash_size))
+    pixels = np.asarray(image.convert('L').resize((hash_size + 1, hash_size),
+                                                  Image.BILINEAR),
+                        dtype='int16')
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    # signed, as csv and pandas handle int64 better than uint64
+    return int(np.packbits(bits).view('>i8')[0])
+
+
+def hash_image(file_path: str):
+    """ size, sha1 and dHash of an image, dHash None if it does not decode """
+    with open(file_path, 'rb') as file:
+        content = file.read()
+    content_hash = hashlib.sha1(content).hexdigest()
+    try:
+        with Image.open(file_path) as image:
+            perceptual_hash = difference_hash(image)
+    except Exception:
+        perceptual_hash = None
+    return len(content), content_hash, perceptual_hash
+
+
+def list_images(path: str, directory: str):
+    """ relative paths of the images of a flat or class sorted directory """
+    directory_path = os.path.join(path, directory)
+    files = []
+    for root, _, file_names in os.walk(directory_path):
+        files += [os.path.relpath(os.path.join(root, f), directory_path)
+                  for f in file_names]
+    return sorted(files)
+
+
+def build_index(path: str, directories, workers: int = 8):
+    rows = []
+    for directory in directories:
+        rows += [(directory, f) for f in list_images(path, directory)]
+    index = pd.DataFrame(rows, columns=['directory', 'subDirectory_filePath'])
+    print('** {} images to hash **'.format(len(index)))
+
+    file_paths = [os.path.join(path, d, f) for d, f in rows]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        hashes = list(executor.map(hash_image, file_paths, chunksize=256))
+
+    index['file_size'] = np.array([h[0] for h in hashes], dtype='int64')
+    index['sha1'] = [h[1] for h in hashes]
+    index['decoded'] = [h[2] is not None for h in hashes]
+    index['dhash'] = np.array([h[2] or 0 for h in hashes], dtype='int64')
+    return index
+
+
+def near_duplicates(index, threshold: int = 3):
+    """
+    Pairs of rows whose dHash differ by at most threshold bits. With
+    threshold + 1 bands, two such hashes share at least one band, so only
+    rows in the same band bucket are compared.
+    """
+    hashes = index['dhash'].values.astype('int64').view('uint64')
+    valid = index['decoded'].values.astype(bool)
+    bands = threshold + 1
+    band_bits = 64 // bands
+    pairs = set()
+    for band in range(bands):
+        keys = (hashes >> np.uint64(band * band_bits)) & \
+            np.uint64((1 << band_bits) - 1)
+        valid_rows = np.flatnonzero(valid)
+        order = valid_rows[np.argsort(keys[valid_rows], kind='stable')]
+        boundaries = np.flatnonzero(keys[order][1:] != keys[order][:-1]) + 1
+        for rows in np.split(order, boundaries):
+            if len(rows) < 2:
+                continue
+            # blocks of rows bound the memory of large buckets
+            for start in range(0, len(rows), 1024):
+                xor = hashes[rows[start:start + 1024], None] ^ \
+                    hashes[None, rows]
+                distances = popcount[xor.view('uint8')] \
+                    .reshape(xor.shape + (8,)).sum(axis=2)
+                first, second = np.nonzero(distances <= threshold)
+                first += start
+                later = second > first
+                pairs.update(zip(rows[first[later]], rows[second[later]]))
+    return sorted(pairs)
+
+
+def report(index, threshold: int = 3, leakage_file: str = None):
+    duplicated = index['sha1'].duplicated(keep='first')
+    print('** {} images, {} distinct contents, {:.1f} MB in duplicates **'
+          .format(len(index), len(index) - duplicated.sum(),
+                  index['file_size'][duplicated].sum() / 1e6))
+    for directory, group in index.groupby('directory'):
+        print('** {}: {} images, {} duplicates within **'.format(
+            directory, len(group), group['sha1'].duplicated().sum()))
+
+    pairs = near_duplicates(index, threshold)
+    if not pairs:
+        print('** no near duplicates **')
+        return pd.DataFrame()
+    first, second = np.array(pairs).T
+    pairs = pd.DataFrame({
+        'directory_1': index['directory'].values[first],
+        'file_1': index['subDirectory_filePath'].values[first],
+        'directory_2': index['directory'].values[second],
+        'file_2': index['subDirectory_filePath'].values[second],
+        'identical': index['sha1'].values[first] ==
+        index['sha1'].values[second]})
+    print('** {} near duplicate pairs, {} identical **'.format(
+        len(pairs), pairs['identical'].sum()))
+
+    leakage = pairs[pairs['directory_1'] != pairs['directory_2']]
+    for (directory_1, directory_2), group in leakage.groupby(
+            ['directory_1', 'directory_2']):
+        print('** leakage {} <-> {}: {} pairs, {} identical **'.format(
+            directory_1, directory_2, len(group), group['identical'].sum()))
+    if leakage_file is not None:
+        leakage.to_csv(leakage_file, index=False)
+    return leakage
+
+
+def get_blob_names(index):
+    extensions = index['subDirectory_filePath'].str.extract(
+        r'(\.[^./]*)$', expand=False).fillna('').str.lower()
+    return index['sha1'] + extensions
+
+
+def create_blob_store(path: str, index, store: str, mode: str = 'hardlink'):
+    """ link every distinct content once into path + store """
+    index = index.assign(blob=get_blob_names(index)) \
+        .drop_duplicates('blob')
+    sources = (path + index['directory'] + '/' +
+               index['subDirectory_filePath']).tolist()
+    copy_images(sources, path + store, mode=mode,
+                names=index['blob'].tolist())
+
+
+def to_blob_paths(dataframe, index, directory: str):
+    """
+    Replace the subDirectory_filePath of a dataframe of directory by the
+    blob names of the store, rows missing from the index raise a ValueError
+    """
+    index = index[index['directory'] == directory]
+    blobs = pd.Series(get_blob_names(index).values,
+                      index=index['subDirectory_filePath'].values)
+    blob_paths = dataframe['subDirectory_filePath'].map(blobs)
+    if blob_paths.isna().any():
+        raise ValueError('Images missing from the dedup index',
+                         dataframe['subDirectory_filePath'][blob_paths.isna()]
+                         .tolist()[:10])
+    return dataframe.assign(subDirectory_filePath=blob_paths)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--path",
+                        help="path to the affectnet directory")
+    parser.add_argument("-d", "--directories", nargs='+',
+                        help="image directories to index")
+    parser.add_argument("-o", "--output", default='dedup_index.csv',
+                        help="name of the index csv")
+    parser.add_argument("-t", "--threshold", type=int, default=3,
+                        help="maximal dHash distance of near duplicates")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="number of processes")
+    parser.add_argument("-b", "--blob_store", default=None,
+                        help="name of the blob store to create")
+    parser.add_argument("-m", "--mode", default='hardlink',
+                        help="copy, hardlink, reflink or auto")
+
+    args = parser.parse_args()
+
+    print('Processing started at {}'.format(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ))
+
+    dedup_index = build_index(args.path, args.directories, args.workers)
+    dedup_index.to_csv(args.path + args.output, index=False)
+    report(dedup_index, args.threshold,
+           args.path + os.path.splitext(args.output)[0] + '_leakage.csv')
+
+    if args.blob_store is not None:
+        create_blob_store(args.path, dedup_index, args.blob_store, args.mode)
+
+    print('Processing finished at {}'.format(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ))
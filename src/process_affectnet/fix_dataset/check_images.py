@@ -1,26 +1,124 @@
+"""
+Scan every image below a directory on a process pool with a full decode
+(Image.open only reads the header and misses truncated files), flag empty,
+undecodable and too small images and write their relative paths to the
+quarantine list <path>.quarantine. The list is dropped automatically by
+process_affectnet, the manifest and get_generator.
+
+The results are cached by file size and mtime in <path>.scan.json, a re-scan
+only decodes the new or modified images.
+
+run: python -m src.process_affectnet.fix_dataset.check_images -p /data/affectnet/Manually_Annotated_Images
+"""
 import os
+import json
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 
 from PIL import Image
 
+from src.utils.manifest import get_quarantine_path
+
+
+def get_scan_cache_path(path: str):
+    return os.path.normpath(path) + '.scan.json'
+
+
+def list_images(path: str):
+    """ relative path, size and mtime of every file below path """
+    files = []
+    for root, _, file_names in os.walk(path):
+        for file_name in file_names:
+            file_path = os.path.join(root, file_name)
+            stat = os.stat(file_path)
+            files.append((os.path.relpath(file_path, path),
+                          stat.st_size, stat.st_mtime_ns))
+    return files
+
+
+def check_image(file_path: str, min_size: int = 1):
+    """ None if the image decodes, the reason otherwise """
+    if os.stat(file_path).st_size == 0:
+        return 'empty'
+    try:
+        with Image.open(file_path) as image:
+            width, height = image.size
+            # full decode, raises on truncated data
+            image.load()
+    except Exception as error:
+        return 'decode: {}'.format(error)
+    if width < min_size or height < min_size:
+        return 'size: {}x{}'.format(width, height)
+    return None
+
+
+def _check_image(arguments):
+    return check_image(*arguments)
+
+
+def check_images(path: str, workers: int = 8, min_size: int = 1):
+
+    print('Processing started at {}'.format(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ))
+
+    cache_path = get_scan_cache_path(path)
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as json_file:
+            cache = json.load(json_file)
+        # a new minimal size invalidates the results
+        if cache.get('min_size') != min_size:
+            cache = {}
+    results = cache.get('results', {})
+
+    files = list_images(path)
+    to_scan = [(name, size, mtime) for name, size, mtime in files
+               if results.get(name, [None, None])[:2] != [size, mtime]]
+    print('** {} images, {} to scan **'.format(len(files), len(to_scan)))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        reasons = executor.map(_check_image,
+                               [(os.path.join(path, name), min_size)
+                                for name, _, _ in to_scan],
+                               chunksize=256)
+        for i, ((name, size, mtime), reason) in enumerate(zip(to_scan,
+                                                             reasons)):
+            results[name] = [size, mtime, reason]
+            if reason is not None:
+                print('corrupt file {}: {}'.format(name, reason))
+            if (i + 1) % 10000 == 0:
+                print('processed images: {}'.format(i + 1))
+
+    # forget the removed files
+    existing = set(name for name, _, _ in files)
+    results = {k: v for k, v in results.items() if k in existing}
+
+    with open(cache_path, 'w') as json_file:
+        json.dump({'min_size': min_size, 'results': results}, json_file)
 
-def check_images(path: str):
+    quarantine = sorted(k for k, v in results.items() if v[2] is not None)
+    with open(get_quarantine_path(path), 'w') as quarantine_file:
+        quarantine_file.write(''.join(name + '\n' for name in quarantine))
+    print('** {} images quarantined **'.format(len(quarantine)))
 
-    for file in os.listdir(path):
-        file_path = os.path.join(path, file)
-        print('** Path: {}  **'.format(file_path), end="\r", flush=True)
-        try:
-            im = Image.open(file_path)
-        except:
-            print('corrupt file {}'.format(file))
+    print('Processing finished at {}'.format(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ))
+    return quarantine
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument("-p", "--path",
                         help="path to the affectnet directory")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="number of processes")
+    parser.add_argument("-s", "--size", type=int, default=1,
+                        help="minimal width and height")
 
     args = parser.parse_args()
     affectnet_path = args.path
 
-    check_images(affectnet_path)
+    check_images(affectnet_path, args.workers, args.size)
@@ -1,44 +1,61 @@
+"""
+Replace the affectnet expression numbers of a csv by their names.
+
+The names are taken in the order of the affectnet numbering (0: Neutral ...
+10: Non-Face) or from the class_names of a dataset json (-d), which then must
+follow the same numbering.
+With --codes the expression column keeps compact int8 codes and the names
+are written once to a lookup table <new>.classes.json. The codes follow the
+sorted names, i.e. they are the class indices of get_generator.
+
+run: python -m src.process_affectnet.fix_dataset.rename_expression_column -p /data/affectnet/ -o training_modified -n training_modified_renamed
+"""
 import os
-import shutil
+import json
 from argparse import ArgumentParser
 
+import numpy as np
 import pandas as pd
 
+from src.utils.manifest import get_class_names_path
+
+affectnet_class_names = ['Neutral', 'Happy', 'Sad', 'Surprise', 'Fear',
+                         'Disgust', 'Anger', 'Contempt', 'None', 'Uncertain',
+                         'Non-Face']
+
 
-def rename_csv(path: str, old_name: str, new_name: str):
+def rename_csv(path: str, old_name: str, new_name: str,
+               class_names=None, codes: bool = False):
+    if not class_names:
+        class_names = affectnet_class_names
 
     # read the csv
     dataframe = pd.read_csv(path + old_name + ".csv")
-    # copy the limited amount of images from the old into the new directory
-    for index, row in enumerate(dataframe.iterrows()):
-        number = dataframe.loc[index, 'expression']
-        if number == 0:
-            dataframe.loc[index, 'expression'] = 'Neutral'
-        elif number == 1:
-            dataframe.loc[index, 'expression'] = 'Happy'
-        elif number == 2:
-            dataframe.loc[index, 'expression'] = 'Sad'
-        elif number == 3:
-            dataframe.loc[index, 'expression'] = 'Surprise'
-        elif number == 4:
-            dataframe.loc[index, 'expression'] = 'Fear'
-        elif number == 5:
-            dataframe.loc[index, 'expression'] = 'Disgust'
-        elif number == 6:
-            dataframe.loc[index, 'expression'] = 'Anger'
-        elif number == 7:
-            dataframe.loc[index, 'expression'] = 'Contempt'
-        elif number == 8:
-            dataframe.loc[index, 'expression'] = 'None'
-        elif number == 9:
-            dataframe.loc[index, 'expression'] = 'Uncertain'
-        elif number == 10:
-            dataframe.loc[index, 'expression'] = 'Non-Face'
-
-        if index % 1000 == 0:
-            print('processed rows: {}'.format(index))
-
-    dataframe.to_csv(path + new_name + ".csv", index=False)
+    numbers = dataframe['expression'].values
+    if numbers.min() < 0 or numbers.max() >= len(class_names):
+        raise ValueError('Expression numbers out of the class names range',
+                         (numbers.min(), numbers.max()))
+
+    # map every number to its name at once
+    expressions = pd.Categorical.from_codes(numbers, categories=class_names)
+
+    new_file = path + new_name + ".csv"
+    class_names_path = get_class_names_path(new_file)
+    if codes:
+        # only the present classes, sorted as the string labels would be
+        expressions = expressions.remove_unused_categories()
+        sorted_names = sorted(expressions.categories)
+        expressions = expressions.reorder_categories(sorted_names)
+        dataframe['expression'] = expressions.codes.astype(np.int8)
+        with open(class_names_path, 'w') as json_file:
+            json.dump(sorted_names, json_file)
+    else:
+        dataframe['expression'] = expressions
+        # a stale lookup table would turn the names into codes
+        if os.path.exists(class_names_path):
+            os.remove(class_names_path)
+
+    dataframe.to_csv(new_file, index=False)
 
 
 if __name__ == '__main__':
@@ -49,10 +66,20 @@ if __name__ == '__main__':
                         help="old name")
     parser.add_argument("-n", "--new",
                         help="new name")
+    parser.add_argument("-d", "--dataset", default=None,
+                        help="dataset json to take the class names from")
+    parser.add_argument("--codes", action='store_true',
+                        help="store int8 codes and a lookup table")
 
     args = parser.parse_args()
     affectnet_path = args.path
     old = args.old
     new = args.new
 
-    rename_csv(affectnet_path, old, new)
+    dataset_class_names = None
+    if args.dataset is not None:
+        with open('src/configuration/dataset/{}.json'
+                          .format(args.dataset)) as json_file:
+            dataset_class_names = json.load(json_file)['class_names']
+
+    rename_csv(affectnet_path, old, new, dataset_class_names, args.codes)
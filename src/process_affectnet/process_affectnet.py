@@ -2,15 +2,43 @@
 This script removes a picture that has zero bytes and where causing issues while
 running the initial affectnet database
 It also remove the path folder as the flow_from_dataframe cannot handle it
+The csv is rewritten with vectorized string operations, the images are then
+copied in parallel by src/process_affectnet/copy_images.py, which journals
+the copied files so that a restart resumes where it stopped
 """
-import os
 from argparse import ArgumentParser
 from datetime import datetime
 import pandas as pd
-import shutil
 
+from src.process_affectnet.copy_images import copy_images
+from src.utils.manifest import read_quarantine
 
-def process_affectnet(path: str, train: bool):
+corrupted_image = '29a31ebf1567693f4644c8ba3476ca9a72ee07fe67a5860d98707a0a.jpg'
+
+
+def remove_sub_folders(dataframe, quarantine=()):
+    """
+    Drop the corrupted picture, the quarantined ones and the sub-folder of
+    every path, return the new dataframe and the original paths of the kept
+    rows
+    """
+    image_paths = dataframe['subDirectory_filePath']
+    images = image_paths.str.split('/', n=1, expand=True)[1]
+
+    # locate the picture that causes problems
+    corrupted = images.str.contains(corrupted_image, regex=False) | \
+        image_paths.isin(quarantine)
+    if corrupted.any():
+        print('deleting row number: {}'.format(
+            list(dataframe.index[corrupted])))
+
+    dataframe = dataframe[~corrupted].copy()
+    dataframe['subDirectory_filePath'] = images[~corrupted]
+    return dataframe, image_paths[~corrupted]
+
+
+def process_affectnet(path: str, train: bool, copy: bool = True,
+                      start: int = 0, mode: str = 'copy'):
 
     print('Processing started at {}'.format(
         datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -18,60 +46,29 @@ def process_affectnet(path: str, train: bool):
 
     if train:
         file_name = 'Manually_Annotated_file_lists/training.csv'
+        new_name = 'training'
     else:
         file_name = 'Manually_Annotated_file_lists/validation.csv'
+        new_name = 'validation'
 
     dataframe = pd.read_csv(path + file_name)
-
-    processed_images = 0
-
-    for index, image_path in enumerate(dataframe.loc[:,
-                                       'subDirectory_filePath']):
-
-        # locate the picture that causes problems
-        idx = None
-        directory, image = image_path.split('/')
-        dataframe.loc[index, 'subDirectory_filePath'] = image
-
-        if '29a31ebf1567693f4644c8ba3476ca9a72ee07fe67a5860d98707a0a.jpg' \
-                in image:
-            idx = index
-
-        # remove the picture from the dataframe
-        if idx is not None:
-            try:
-                print('deleting row number: {}'.format(idx))
-                dataframe = dataframe.drop([idx])
-            except KeyError:
-                print('Could not delete row {}'.format(idx))
-
-        # remove the sub-folder
-        if train:
-            new_training_path = path + 'training'
-            if not os.path.exists(new_training_path):
-                os.mkdir(new_training_path)
-            if not os.path.exists(new_training_path + '/' + image_path):
-                shutil.copy(path + 'Manually_Annotated_Images/' + image_path,
-                            new_training_path + '/')
-        else:
-            new_validation_path = path + 'validation'
-            if not os.path.exists(new_validation_path):
-                os.mkdir(new_validation_path)
-            if not os.path.exists(new_validation_path + '/' + image_path):
-                shutil.copy(path + 'Manually_Annotated_Images/' + image_path,
-                            new_validation_path + '/')
-
-        processed_images = processed_images + 1
-
-        if processed_images % 1000 == 0:
-            print('processed images: {}'.format(processed_images))
-
+    # images flagged by fix_dataset/check_images.py
+    quarantine = read_quarantine(path + 'Manually_Annotated_Images')
+    dataframe, image_paths = remove_sub_folders(dataframe, quarantine)
 
     # save the new csv file with no sub folders and this weird pictures
-    if train:
-        dataframe.to_csv(path + "training_modified.csv", index=False)
-    else:
-        dataframe.to_csv(path + "validation_modified.csv", index=False)
+    dataframe.to_csv(path + new_name + "_modified.csv", index=False)
+    print('csv written at {}'.format(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ))
+
+    # remove the sub-folder of the images, start is a row of the original
+    # csv: the index of image_paths, the dropped rows leave gaps in it
+    if copy:
+        copy_images((path + 'Manually_Annotated_Images/' +
+                     image_paths.loc[start:]).tolist(),
+                    path + new_name,
+                    mode=mode)
 
     print('Processing finished at {}'.format(
         datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -84,9 +81,14 @@ if __name__ == '__main__':
                         help="path to the affectnet directory")
     parser.add_argument("-t", "--train", type=bool,
                         help="use to create training dir, else not")
+    parser.add_argument("--no_copy", action='store_true',
+                        help="only rewrite the csv")
+    parser.add_argument("-m", "--mode", default='copy',
+                        help="copy, hardlink, reflink or auto")
 
     args = parser.parse_args()
     affectnet_path = args.path
     training_bool = args.train
 
-    process_affectnet(affectnet_path, training_bool)
+    process_affectnet(affectnet_path, training_bool, not args.no_copy,
+                      mode=args.mode)
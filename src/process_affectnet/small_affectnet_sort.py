@@ -1,33 +1,48 @@
-import shutil
+"""
+Sort the images of a small affectnet into categorical_<split><name>/<label>/
+folders, for the "labels_type": "directory" datasets.
+
+The class folders are created once and populated in parallel by
+src/process_affectnet/copy_images.py: with the hardlink or symlink mode a
+directory layout view costs almost no disk space or time, so any number of
+them can share the same source images.
+
+run: python -m src.process_affectnet.small_affectnet_sort -p /data/affectnet/ -n small5000 -m symlink
+"""
 import os
+from argparse import ArgumentParser
+
 import pandas as pd
 
+from src.process_affectnet.copy_images import copy_images
+
 
 def loop_over(path: str,
               old_path: str,
               name: str,
               size_name: str,
-              dataframe):
+              dataframe,
+              mode: str = 'copy'):
 
     # columns in the csv file
     image_name = 'subDirectory_filePath'
     label_name = 'expression'
 
-    # loop over the dataframe and copy the images into the label folder
-    for index, row in enumerate(dataframe.iterrows()):
-
-        img_name = dataframe.loc[index, image_name]
-        label = dataframe.loc[index, label_name]
+    new_directory = path + 'categorical_' + name + size_name
+    labels = dataframe[label_name].astype(str)
 
-        new_path = path + 'categorical_' + name + size_name + '/' + str(label)
-        if not os.path.exists(new_path):
-            os.mkdir(new_path)
+    # create the label folders once
+    for label in labels.unique():
+        os.makedirs(os.path.join(new_directory, label), exist_ok=True)
 
-        shutil.copyfile(old_path + '/' + img_name,
-                        new_path + '/' + image_name)
+    # copy or link the images into their label folder
+    copy_images((old_path + '/' + dataframe[image_name]).tolist(),
+                new_directory,
+                mode=mode,
+                names=(labels + '/' + dataframe[image_name]).tolist())
 
 
-def sort_small_affectnet(name: str, path: str):
+def sort_small_affectnet(name: str, path: str, mode: str = 'copy'):
 
     training_csv_name = path + 'training_'+name+'.csv'
     training_directory = path + 'training_'+name
@@ -37,6 +52,21 @@ def sort_small_affectnet(name: str, path: str):
     training_dataframe = pd.read_csv(training_csv_name)
     validation_dataframe = pd.read_csv(validation_csv_name)
 
-    loop_over(path, training_directory, 'training_', name, training_dataframe)
+    loop_over(path, training_directory, 'training_', name, training_dataframe,
+              mode)
     loop_over(path, validation_directory, 'validation_', name,
-              validation_dataframe)
+              validation_dataframe, mode)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--path",
+                        help="path to the affectnet directory")
+    parser.add_argument("-n", "--name",
+                        help="name of the small affectnet, e.g. small5000")
+    parser.add_argument("-m", "--mode", default='copy',
+                        help="copy, hardlink, symlink, reflink or auto")
+
+    args = parser.parse_args()
+
+    sort_small_affectnet(args.name, args.path, args.mode)
@@ -0,0 +1,162 @@
+import numpy as np
+import tensorflow as tf
+
+"""
+Batched affine augmentation with the semantics of ImageDataGenerator
+(rotation_range, width/height_shift_range, zoom_range, horizontal_flip,
+bilinear interpolation and fill_mode='nearest').
+
+One transform is sampled per image and the whole batch is warped at once,
+either in-graph with ImageProjectiveTransformV3 (tf.data pipelines) or with
+a single vectorized numpy gather (keras Sequences).
+
+Transforms use the ImageProjectiveTransform convention: a row
+[a0, a1, a2, b0, b1, b2, c0, c1] maps an output pixel (x, y) to the input
+pixel (a0 x + a1 y + a2, b0 x + b1 y + b2).
+"""
+
+
+def get_augmentation_parameters(data_generator):
+    """
+    Read the random transform ranges of a keras ImageDataGenerator.
+    Return None if the generator does not apply any geometric transform.
+    A transform that is not reproduced in batch raises a ValueError, so the
+    tf.data and Sequence loaders never train on other images than the keras
+    iterators.
+    """
+    unsupported = {'shear_range': data_generator.shear_range,
+                   'vertical_flip': data_generator.vertical_flip,
+                   'channel_shift_range': data_generator.channel_shift_range,
+                   'brightness_range': data_generator.brightness_range}
+    unsupported = {k: v for k, v in unsupported.items() if v}
+    if unsupported:
+        raise ValueError('Batch augmentation does not support the transforms',
+                         unsupported)
+
+    parameters = {'rotation_range': data_generator.rotation_range,
+                  'width_shift_range': data_generator.width_shift_range,
+                  'height_shift_range': data_generator.height_shift_range,
+                  'zoom_range': [float(z) for z in data_generator.zoom_range],
+                  'horizontal_flip': data_generator.horizontal_flip}
+
+    if not parameters['rotation_range'] and \
+            not parameters['width_shift_range'] and \
+            not parameters['height_shift_range'] and \
+            parameters['zoom_range'] == [1., 1.] and \
+            not parameters['horizontal_flip']:
+        return None
+
+    if data_generator.fill_mode != 'nearest':
+        raise ValueError('Batch augmentation only supports fill_mode nearest',
+                         data_generator.fill_mode)
+    return parameters
+
+
+def _affine_rows(cos, sin, tx, ty, zx, zy, flip, height, width):
+    """
+    Output to input mapping of rotation @ shift @ zoom around the image
+    center (as apply_affine_transform), followed by a horizontal flip where
+    flip is -1. Only uses arithmetic so it works on numpy and tf alike.
+    """
+    cx = (width - 1) / 2
+    cy = (height - 1) / 2
+
+    a0 = cos * zx
+    a1 = -sin * zy
+    b0 = sin * zx
+    b1 = cos * zy
+    a2 = cos * tx - sin * ty + cx - (a0 * cx + a1 * cy)
+    b2 = sin * tx + cos * ty + cy - (b0 * cx + b1 * cy)
+
+    # mirror the output columns: x -> width - 1 - x
+    a2 = a2 + (1 - flip) / 2 * a0 * (width - 1)
+    b2 = b2 + (1 - flip) / 2 * b0 * (width - 1)
+    return [flip * a0, a1, a2, flip * b0, b1, b2]
+
+
+def sample_transforms(batch_size: int, height: int, width: int, parameters,
+                      rng=np.random):
+    """ numpy version, returns a (batch_size, 8) float32 array """
+    theta = np.deg2rad(rng.uniform(-parameters['rotation_range'],
+                                   parameters['rotation_range'], batch_size))
+    tx = rng.uniform(-parameters['width_shift_range'],
+                     parameters['width_shift_range'], batch_size) * width
+    ty = rng.uniform(-parameters['height_shift_range'],
+                     parameters['height_shift_range'], batch_size) * height
+    zx = rng.uniform(*parameters['zoom_range'], batch_size)
+    zy = rng.uniform(*parameters['zoom_range'], batch_size)
+    flip = np.ones(batch_size)
+    if parameters['horizontal_flip']:
+        flip[rng.uniform(size=batch_size) < 0.5] = -1
+
+    rows = _affine_rows(np.cos(theta), np.sin(theta), tx, ty, zx, zy, flip,
+                        height, width)
+    zeros = np.zeros(batch_size)
+    return np.stack(rows + [zeros, zeros], axis=1).astype('float32')
+
+
+def sample_transforms_tf(batch_size, height: int, width: int, parameters):
+    """ in-graph version, returns a (batch_size, 8) float32 tensor """
+    def uniform(low, high):
+        return tf.random.uniform([batch_size], low, high)
+
+    theta = uniform(-parameters['rotation_range'],
+                    parameters['rotation_range']) * np.pi / 180
+    tx = uniform(-parameters['width_shift_range'],
+                 parameters['width_shift_range']) * width
+    ty = uniform(-parameters['height_shift_range'],
+                 parameters['height_shift_range']) * height
+    zx = uniform(*parameters['zoom_range'])
+    zy = uniform(*parameters['zoom_range'])
+    flip = tf.ones([batch_size])
+    if parameters['horizontal_flip']:
+        flip = tf.where(tf.random.uniform([batch_size]) < 0.5, -flip, flip)
+
+    rows = _affine_rows(tf.cos(theta), tf.sin(theta), tx, ty, zx, zy, flip,
+                        height, width)
+    zeros = tf.zeros([batch_size])
+    return tf.stack(rows + [zeros, zeros], axis=1)
+
+
+def affine_transform_batch(images, transforms):
+    """
+    Warp a (B, H, W, C) batch with one bilinear gather, the input
+    coordinates are clamped to the border (fill_mode nearest).
+    """
+    batch_size, height, width, _ = images.shape
+    ys, xs = np.meshgrid(np.arange(height, dtype='float32'),
+                         np.arange(width, dtype='float32'), indexing='ij')
+    t = transforms[:, :, None, None]
+    x = np.clip(t[:, 0] * xs + t[:, 1] * ys + t[:, 2], 0, width - 1)
+    y = np.clip(t[:, 3] * xs + t[:, 4] * ys + t[:, 5], 0, height - 1)
+
+    x0 = np.floor(x).astype('int32')
+    y0 = np.floor(y).astype('int32')
+    x1 = np.minimum(x0 + 1, width - 1)
+    y1 = np.minimum(y0 + 1, height - 1)
+    wx = (x - x0)[..., None]
+    wy = (y - y0)[..., None]
+
+    b = np.arange(batch_size)[:, None, None]
+    top = images[b, y0, x0] * (1 - wx) + images[b, y0, x1] * wx
+    bottom = images[b, y1, x0] * (1 - wx) + images[b, y1, x1] * wx
+    return (top * (1 - wy) + bottom * wy).astype('float32')
+
+
+def augment_batch(images, parameters, rng=np.random):
+    transforms = sample_transforms(len(images), images.shape[1],
+                                   images.shape[2], parameters, rng)
+    return affine_transform_batch(images, transforms)
+
+
+def augment_batch_tf(images, parameters):
+    shape = tf.shape(images)
+    transforms = sample_transforms_tf(shape[0], images.shape[1],
+                                      images.shape[2], parameters)
+    return tf.raw_ops.ImageProjectiveTransformV3(
+        images=images,
+        transforms=transforms,
+        output_shape=shape[1:3],
+        fill_value=0.,
+        interpolation='BILINEAR',
+        fill_mode='NEAREST')
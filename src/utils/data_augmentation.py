@@ -205,3 +205,39 @@ def get_data_generator(dataset_parameters, train=True):
                          % dataset_parameters['data_augmentation'])
 
     return data_generator
+
+
+def get_preprocessing_function(dataset_parameters):
+    """
+    Return the pixel normalisation of get_data_generator as a function that
+    works on float batches (numpy or tf), for pipelines that do not go
+    through an ImageDataGenerator.
+    """
+    # No Data augmentation
+    if not dataset_parameters['data_augmentation'] or \
+            dataset_parameters['data_augmentation'] == 1:
+        def preprocess_fn(x):
+            return x / 255.
+
+    elif dataset_parameters['data_augmentation'] in ['resnet_basic',
+                                                     'resnet_augmentation']:
+        preprocess_fn = resnet.preprocess_input
+
+    elif dataset_parameters['data_augmentation'] in ['resnetv2_basic',
+                                                     'resnetv2_augmentation']:
+        preprocess_fn = resnet_v2.preprocess_input
+
+    elif dataset_parameters['data_augmentation'] == 2:
+        mean_rgb = dataset_parameters['mean_RGB']
+        std_rgb = dataset_parameters['std_RGB']
+
+        def preprocess_fn(x):
+            return (x / 255. - mean_rgb) / std_rgb
+
+    else:
+        raise ValueError('Wrong data_processing augmentation selection - '
+                         '%s doest not exist'
+                         % dataset_parameters['data_augmentation'])
+
+    return preprocess_fn
+
@@ -0,0 +1,163 @@
+import os
+import json
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from src.utils.sequences import load_image
+from src.utils.manifest import read_csv_labels
+
+"""
+One streaming, parallel pass over the training set of a dataset
+configuration to compute the per channel mean_RGB/ std_RGB (in [0, 1]), the
+number of images per class and the inverse frequency class weights
+(largest class count / class count). The results are written back into the
+dataset json.
+
+Every worker accumulates (count, mean, M2) over its chunk of images with
+Welford's update and the chunks are merged with Chan's formula, so memory
+stays bounded whatever the size of the dataset.
+
+run: python -m src.utils.dataset_statistics -d affectnet -c blue
+"""
+
+chunk_size = 512
+
+
+def merge_statistics(a, b):
+    """ Chan et al. parallel merge of two (count, mean, M2) triplets """
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    if count == 0:
+        return a
+    delta = mean_b - mean_a
+    mean = mean_a + delta * count_b / count
+    m2 = m2_a + m2_b + delta ** 2 * count_a * count_b / count
+    return count, mean, m2
+
+
+def empty_statistics():
+    return 0, np.zeros(3), np.zeros(3)
+
+
+def image_statistics(image):
+    pixels = image.reshape(-1, 3).astype('float64') / 255.
+    mean = pixels.mean(axis=0)
+    return len(pixels), mean, ((pixels - mean) ** 2).sum(axis=0)
+
+
+def chunk_statistics(file_paths, size: int):
+    statistics = empty_statistics()
+    for file_path in file_paths:
+        try:
+            image = load_image(file_path, size, size)
+        except OSError:
+            print('** could not read {} **'.format(file_path))
+            continue
+        statistics = merge_statistics(statistics, image_statistics(image))
+    return statistics
+
+
+def list_dataset(dataset_parameters, computer_parameters):
+    """ file paths, labels and class indices of the training set """
+    directory = os.path.join(computer_parameters['dataset_path'],
+                             dataset_parameters['training_directory'])
+
+    if 'csv' in dataset_parameters['labels_type']:
+        dataframe, class_indices = read_csv_labels(
+            os.path.join(computer_parameters['dataset_path'],
+                         dataset_parameters['csv_training_file']),
+            dataset_parameters['class_label'])
+        file_paths = [os.path.join(directory, file_name) for file_name
+                      in dataframe['subDirectory_filePath']]
+        labels = dataframe[dataset_parameters['class_label']]
+    else:
+        # one sub-folder per class, in the order of the class_names given to
+        # image_dataset_from_directory, else alphabetical as keras does
+        class_names = dataset_parameters.get('class_names') or \
+            sorted(d for d in os.listdir(directory)
+                   if os.path.isdir(os.path.join(directory, d)))
+        file_paths, labels = [], []
+        for class_name in class_names:
+            class_directory = os.path.join(directory, class_name)
+            if not os.path.isdir(class_directory):
+                continue
+            for entry in os.scandir(class_directory):
+                file_paths.append(entry.path)
+                labels.append(class_name)
+        labels = pd.Series(labels)
+        class_indices = dict(zip(class_names, range(len(class_names))))
+
+    return file_paths, labels, class_indices
+
+
+def compute_statistics(dataset_parameters, computer_parameters,
+                       size: int = 224, workers: int = 8):
+    file_paths, labels, class_indices = list_dataset(dataset_parameters, computer_parameters)
+
+    statistics = empty_statistics()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(chunk_statistics,
+                                   file_paths[start:start + chunk_size],
+                                   size)
+                   for start in range(0, len(file_paths), chunk_size)]
+        for i, future in enumerate(futures):
+            statistics = merge_statistics(statistics, future.result())
+            if (i + 1) % 20 == 0:
+                print('processed images: {}'.format((i + 1) * chunk_size))
+
+    count, mean, m2 = statistics
+    std = np.sqrt(m2 / count)
+
+    # class weights follow the label indices of the generators
+    class_counts = labels.value_counts()
+    counts = [int(class_counts.get(class_name, 0))
+              for class_name in class_indices]
+    class_weights = [max(counts) / c if c else 0. for c in counts]
+
+    return {'mean_RGB': [round(float(m), 4) for m in mean],
+            'std_RGB': [round(float(s), 4) for s in std],
+            'class_counts': dict(zip(class_indices, counts)),
+            'class_weights': [round(w, 3) for w in class_weights],
+            'num_train_images': len(file_paths)}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument("-d", "--dataset",
+                        help="select your dataset")
+    parser.add_argument("-c", "--computer",
+                        help="select your computer")
+    parser.add_argument("-s", "--size", type=int, default=224,
+                        help="images are resized to this size before the statistics")
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="number of processes")
+
+    args = parser.parse_args()
+
+    dataset_file = 'src/configuration/dataset/{}.json'.format(args.dataset)
+    with open(dataset_file) as json_file:
+        dataset_parameters = json.load(json_file)
+    with open('src/configuration/computer/{}.json'
+                      .format(args.computer)) as json_file:
+        computer_parameters = json.load(json_file)
+
+    print('Processing started at {}'.format(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ))
+
+    results = compute_statistics(dataset_parameters, computer_parameters,
+                                 args.size, args.workers)
+    print(results)
+
+    dataset_parameters.update(results)
+    with open(dataset_file, 'w') as json_file:
+        json.dump(dataset_parameters, json_file, indent=2)
+
+    print('Processing finished at {}'.format(
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    ))
@@ -1,13 +1,156 @@
 import os
 import sys
 import tensorflow as tf
-import pandas as pd
 import numpy as np
 from tensorflow.keras.preprocessing.image import *
 from sklearn.datasets import make_blobs
 # from tensorflow.python.keras.preprocessing.image_dataset import image_dataset_from_directory
 sys.path.insert(0, '../')
 from src.utils.data_augmentation import *
+from src.utils.tf_data_generators import get_csv_dataset
+from src.utils.tf_data_generators import get_tfrecord_dataset
+from src.utils.tf_data_generators import get_cluster_dataset
+from src.utils.image_store import MemmapSequence
+from src.utils.image_cache import ImageCache
+from src.utils.image_cache import CachedImageSequence
+from src.utils.manifest import load_manifest
+from src.utils.manifest import read_csv_labels
+from src.utils.manifest import drop_quarantined
+from src.utils.process_loader import get_process_loader
+
+
+def read_dataframe(csv_file: str, directory: str, dataset_parameters):
+    """
+    Load the dataframe of a csv dataset with string labels, and its class
+    indices, from the compiled manifest if "use_manifest" is set.
+    Quarantined images are dropped.
+    """
+    if dataset_parameters.get('use_manifest', False):
+        return load_manifest(csv_file,
+                             directory,
+                             dataset_parameters['class_label'])
+
+    dataframe, class_indices = read_csv_labels(csv_file,
+                                               dataset_parameters['class_label'])
+    # images flagged by fix_dataset/check_images.py
+    return drop_quarantined(dataframe, directory), class_indices
+
+
+class ClassBalancedSampler(tf.keras.utils.Sequence):
+    """
+    Draw the training batches of a keras iterator or an ImageSequence from a
+    per-class index instead of going once over the dataset. The class of
+    every sample is drawn with a probability proportional to
+    count ** (1 / temperature): "balanced" is the uniform distribution,
+    "temperature" interpolates between it (large temperature) and the natural
+    class frequencies (temperature 1). Within a class the images are visited
+    in a shuffled round robin, so no image repeats before the whole class was
+    seen.
+
+    The per-class index is built once from the classes of the generator,
+    i.e. from the manifest if "use_manifest" is set. An epoch has
+    "steps_per_epoch" batches whatever the size of the dataset.
+    """
+
+    def __init__(self, sequence, dataset_parameters, model_parameters):
+        self.sequence = sequence
+        self.class_indices = sequence.class_indices
+        self.classes = np.asarray(sequence.classes)
+        self.batch_size = model_parameters['batch_size']
+        self.shuffle = True
+        self.seed = dataset_parameters.get('loader_seed', 0)
+        self.epoch = 0
+
+        sampling = dataset_parameters['sampling']
+        if sampling == 'balanced':
+            temperature = np.inf
+        elif sampling == 'temperature':
+            temperature = dataset_parameters.get('sampling_temperature', 1.)
+        else:
+            raise ValueError('Sampling does not exist', sampling)
+
+        # per-class index: the positions of every class, built once
+        order = np.argsort(self.classes, kind='stable')
+        counts = np.bincount(self.classes,
+                             minlength=len(self.class_indices))
+        self.class_samples = np.split(order, np.cumsum(counts)[:-1])
+        self.probabilities = np.where(counts > 0,
+                                      counts.astype('float64') ** (1. / temperature),
+                                      0.)
+        self.probabilities /= self.probabilities.sum()
+
+        self.steps_per_epoch = dataset_parameters.get('steps_per_epoch') or \
+            int(np.ceil(len(self.classes) / self.batch_size))
+        print('** {} sampling, class probabilities: {} **'.format(
+            sampling, np.round(self.probabilities, 3)))
+
+        self.positions = [0] * len(self.class_samples)
+        self.permutations = list(self.class_samples)
+        self.batches = self.epoch_batches(self.epoch)
+
+    def _draw(self, class_id, number, rng):
+        samples = []
+        while number > 0:
+            position = self.positions[class_id]
+            if position == 0:
+                self.permutations[class_id] = rng.permutation(
+                    self.class_samples[class_id])
+            taken = self.permutations[class_id][position:position + number]
+            samples.append(taken)
+            number -= len(taken)
+            self.positions[class_id] = \
+                (position + len(taken)) % len(self.class_samples[class_id])
+        return samples
+
+    def epoch_batches(self, epoch: int):
+        """ index arrays of the batches of an epoch """
+        rng = np.random.RandomState(self.seed + epoch)
+        class_ids = rng.choice(len(self.probabilities),
+                               size=self.steps_per_epoch * self.batch_size,
+                               p=self.probabilities)
+        counts = np.bincount(class_ids, minlength=len(self.probabilities))
+
+        samples = np.empty(len(class_ids), dtype='int64')
+        for class_id in np.flatnonzero(counts):
+            samples[class_ids == class_id] = np.concatenate(
+                self._draw(class_id, counts[class_id], rng))
+
+        # sorted indices turn the random access into forward reads
+        return [np.sort(batch) for batch in
+                np.split(samples, self.steps_per_epoch)]
+
+    def get_batch(self, batch_index):
+        if hasattr(self.sequence, 'get_batch'):
+            return self.sequence.get_batch(batch_index)
+        # keras DataFrameIterator/ DirectoryIterator
+        return self.sequence._get_batches_of_transformed_samples(batch_index)
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def __getitem__(self, index):
+        return self.get_batch(self.batches[index])
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.batches = self.epoch_batches(self.epoch)
+        # e.g. the cache statistics of a CachedImageSequence
+        if hasattr(self.sequence, 'on_epoch_end'):
+            self.sequence.on_epoch_end()
+
+
+def get_sampler(generator, dataset_parameters, model_parameters):
+    """
+    Wrap the training generator into a ClassBalancedSampler if "sampling"
+    is set to "balanced" or "temperature"
+    """
+    if not dataset_parameters.get('sampling') or generator is None:
+        return generator
+    if isinstance(generator, tf.data.Dataset) or \
+            not hasattr(generator, 'classes'):
+        raise ValueError('Sampling is not supported by this input pipeline',
+                         dataset_parameters.get('input_pipeline', 'keras'))
+    return ClassBalancedSampler(generator, dataset_parameters, model_parameters)
 
 
 def get_generator(dataset_parameters,
@@ -16,6 +159,12 @@ def get_generator(dataset_parameters,
                   only_validation: bool = False):
 
     num_classes = dataset_parameters['num_classes']
+    # 'keras' (default) uses the ImageDataGenerator iterators,
+    # 'tf_data' the parallel tf.data pipelines of tf_data_generators,
+    # 'tfrecord' the sharded TFRecord files of create_tfrecords,
+    # 'memmap' the uint8 image store of create_image_store,
+    # 'cache' decodes the csv images once into an on-disk LRU ImageCache
+    input_pipeline = dataset_parameters.get('input_pipeline', 'keras')
     training_data_generator = get_data_generator(dataset_parameters)
     validation_data_generator = get_data_generator(dataset_parameters, False)
     training_generator = None
@@ -46,50 +195,137 @@ def get_generator(dataset_parameters,
             test_label
         )
 
+    # pre-packed shards from src/process_affectnet/create_tfrecords.py
+    elif input_pipeline == 'tfrecord':
+        if not only_validation:
+            training_generator = get_tfrecord_dataset(
+                os.path.join(computer_parameters['dataset_path'],
+                             dataset_parameters['tfrecord_training_directory']),
+                dataset_parameters,
+                model_parameters,
+                train=True)
+
+        validation_generator = get_tfrecord_dataset(
+            os.path.join(computer_parameters['dataset_path'],
+                         dataset_parameters['tfrecord_validation_directory']),
+            dataset_parameters,
+            model_parameters,
+            train=False)
+
+    # pre-resized images from src/process_affectnet/create_image_store.py
+    elif input_pipeline == 'memmap':
+        if not only_validation:
+            training_generator = MemmapSequence(
+                os.path.join(computer_parameters['dataset_path'],
+                             dataset_parameters['image_store_training_directory']),
+                training_data_generator,
+                dataset_parameters,
+                model_parameters,
+                train=True)
+
+        validation_generator = MemmapSequence(
+            os.path.join(computer_parameters['dataset_path'],
+                         dataset_parameters['image_store_validation_directory']),
+            validation_data_generator,
+            dataset_parameters,
+            model_parameters,
+            train=False)
+
     elif 'csv' in dataset_parameters['labels_type']:
+        # a fresh manifest already validated every file
+        use_manifest = dataset_parameters.get('use_manifest', False)
+        if input_pipeline == 'cache':
+            # one cache shared by the training and validation images
+            image_cache = ImageCache(
+                os.path.join(computer_parameters['dataset_path'],
+                             dataset_parameters['image_cache_directory']),
+                int(dataset_parameters['image_cache_size_gb'] * 1024 ** 3))
+
         if not only_validation:
             training_csv_file = os.path.join(computer_parameters['dataset_path'],
                                              dataset_parameters['csv_training_file'])
             training_directory = os.path.join(computer_parameters['dataset_path'],
                                               dataset_parameters['training_directory'])
 
-            training_dataframe = pd.read_csv(training_csv_file)
-            training_dataframe[dataset_parameters['class_label']] = training_dataframe[
-                dataset_parameters['class_label']].astype(str)
+            training_dataframe, training_class_indices = read_dataframe(
+                training_csv_file,
+                training_directory,
+                dataset_parameters)
+
+            if input_pipeline == 'tf_data':
+                training_generator = get_csv_dataset(
+                    training_dataframe,
+                    training_directory,
+                    training_class_indices,
+                    dataset_parameters,
+                    model_parameters,
+                    train=True)
+            elif input_pipeline == 'cache':
+                training_generator = CachedImageSequence(
+                    training_dataframe,
+                    training_directory,
+                    training_class_indices,
+                    image_cache,
+                    training_data_generator,
+                    dataset_parameters,
+                    model_parameters,
+                    train=True)
+            else:
+                training_generator = training_data_generator.flow_from_dataframe(
+                    dataframe=training_dataframe,
+                    directory=training_directory,
+                    x_col='subDirectory_filePath',
+                    y_col=dataset_parameters['class_label'],
+                    class_mode='categorical',
+                    target_size=(model_parameters['image_height'],
+                                 model_parameters['image_width']),
+                    batch_size=model_parameters['batch_size'],
+                    shuffle=True,
+                    validate_filenames=not use_manifest
+                )
 
-            training_generator = training_data_generator.flow_from_dataframe(
-                dataframe=training_dataframe,
-                directory=training_directory,
+        validation_csv_file = os.path.join(computer_parameters['dataset_path'],
+                                           dataset_parameters['csv_validation_file'])
+        validation_directory = os.path.join(computer_parameters['dataset_path'],
+                                            dataset_parameters['validation_directory'])
+
+        validation_dataframe, validation_class_indices = read_dataframe(
+            validation_csv_file,
+            validation_directory,
+            dataset_parameters)
+
+        if input_pipeline == 'tf_data':
+            validation_generator = get_csv_dataset(
+                validation_dataframe,
+                validation_directory,
+                validation_class_indices,
+                dataset_parameters,
+                model_parameters,
+                train=False)
+        elif input_pipeline == 'cache':
+            validation_generator = CachedImageSequence(
+                validation_dataframe,
+                validation_directory,
+                validation_class_indices,
+                image_cache,
+                validation_data_generator,
+                dataset_parameters,
+                model_parameters,
+                train=False)
+        else:
+            validation_generator = validation_data_generator.flow_from_dataframe(
+                dataframe=validation_dataframe,
+                directory=validation_directory,
                 x_col='subDirectory_filePath',
                 y_col=dataset_parameters['class_label'],
                 class_mode='categorical',
                 target_size=(model_parameters['image_height'],
                              model_parameters['image_width']),
                 batch_size=model_parameters['batch_size'],
-                shuffle=True
+                shuffle=False,
+                validate_filenames=not use_manifest
             )
 
-        validation_csv_file = os.path.join(computer_parameters['dataset_path'],
-                                           dataset_parameters['csv_validation_file'])
-        validation_directory = os.path.join(computer_parameters['dataset_path'],
-                                            dataset_parameters['validation_directory'])
-
-        validation_dataframe = pd.read_csv(validation_csv_file)
-        validation_dataframe[dataset_parameters['class_label']] = validation_dataframe[
-            dataset_parameters['class_label']].astype(str)
-
-        validation_generator = validation_data_generator.flow_from_dataframe(
-            dataframe=validation_dataframe,
-            directory=validation_directory,
-            x_col='subDirectory_filePath',
-            y_col=dataset_parameters['class_label'],
-            class_mode='categorical',
-            target_size=(model_parameters['image_height'],
-                         model_parameters['image_width']),
-            batch_size=model_parameters['batch_size'],
-            shuffle=False,
-        )
-
     elif 'directory' in dataset_parameters['labels_type']:
         training_directory = os.path.join(computer_parameters['dataset_path'], dataset_parameters['training_directory'])
         validation_directory = os.path.join(computer_parameters['dataset_path'], dataset_parameters['validation_directory'])
@@ -156,6 +392,17 @@ def get_generator(dataset_parameters,
             test_label
         )
 
+    # balanced/ temperature sampling of the training batches
+    training_generator = get_sampler(training_generator,
+                                     dataset_parameters,
+                                     model_parameters)
+
+    # decode and augment in worker processes if "loader_workers" is set
+    training_generator = get_process_loader(training_generator,
+                                            dataset_parameters)
+    validation_generator = get_process_loader(validation_generator,
+                                              dataset_parameters)
+
     return training_generator, validation_generator
 
 
@@ -170,25 +417,14 @@ def get_cluster_generator(dataset_parameters,
                                        computer_parameters,
                                        only_validation)
 
-    def cluster_generator(generator, batch_size, num_entry):
-        iter = 0
-
-        while True:
-            batch = next(generator)
-            img = batch[0]
-            labels = batch[1]
-            cluster = np.zeros(batch_size)
-
-            x = [img, labels]
-            y = [labels, cluster]
-            yield x, y
-
-            # iter += batch_size
-            # if iter >= num_entry:
-            #     break
-
-    training_generator = cluster_generator(train_gen, model_parameters['batch_size'], 287650)
-    validation_generator = cluster_generator(val_gen, model_parameters['batch_size'], 4000)
+    training_generator = None
+    if train_gen is not None:
+        training_generator = get_cluster_dataset(train_gen,
+                                                 dataset_parameters,
+                                                 model_parameters)
+    validation_generator = get_cluster_dataset(val_gen,
+                                               dataset_parameters,
+                                               model_parameters)
 
     return training_generator, validation_generator
 
@@ -0,0 +1,239 @@
+import os
+import fcntl
+import hashlib
+import threading
+import numpy as np
+
+from src.utils.sequences import ImageSequence
+from src.utils.sequences import load_image
+from src.utils.sequences import get_face_margin
+
+"""
+On-disk cache of decoded and resized images shared across epochs, runs and
+concurrent training processes.
+
+Entries are .npy files named by the hash of (file path, target size, mode).
+They are written to a temporary file and renamed, so readers never see a
+partial entry. The modification time of an entry is its last access and the
+oldest entries are evicted when the cache exceeds its byte budget.
+
+The total size of the entries is kept in a size file (.size) that every
+process updates under the lock file (.lock), so the budget holds for all the
+processes sharing the directory together.
+"""
+
+
+class ImageCache:
+
+    def __init__(self, cache_directory: str, max_bytes: int):
+        self.cache_directory = cache_directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory, exist_ok=True)
+        self._lock_path = os.path.join(cache_directory, '.lock')
+        self._size_path = os.path.join(cache_directory, '.size')
+
+        # reconcile the size file with the directory once per process
+        with open(self._lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self.current_bytes = self._scan_size()
+                self._write_size(self.current_bytes)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def key(file_path: str, target_size, mode: str):
+        return hashlib.sha1('{}|{}x{}|{}'.format(
+            os.path.abspath(file_path), target_size[0], target_size[1], mode)
+            .encode()).hexdigest()
+
+    def _entry_path(self, key: str):
+        return os.path.join(self.cache_directory, key[:2], key + '.npy')
+
+    def _entries(self):
+        for sub_directory in os.scandir(self.cache_directory):
+            if sub_directory.is_dir():
+                for entry in os.scandir(sub_directory.path):
+                    if entry.name.endswith('.npy'):
+                        yield entry
+
+    def _scan_size(self):
+        return sum(entry.stat().st_size for entry in self._entries())
+
+    def _read_size(self):
+        """ shared total size, the lock file must be held """
+        try:
+            with open(self._size_path) as size_file:
+                return int(size_file.read())
+        except (FileNotFoundError, ValueError):
+            # missing or torn by a crash
+            return self._scan_size()
+
+    def _write_size(self, total_bytes: int):
+        """ the lock file must be held """
+        with open(self._size_path, 'w') as size_file:
+            size_file.write(str(total_bytes))
+
+    def get(self, key: str):
+        entry_path = self._entry_path(key)
+        try:
+            image = np.load(entry_path)
+            # mark as recently used for the other processes
+            os.utime(entry_path)
+        except (FileNotFoundError, ValueError, OSError):
+            # missing, evicted meanwhile or not fully written
+            image = None
+
+        with self._lock:
+            if image is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return image
+
+    def put(self, key: str, image):
+        entry_path = self._entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        temp_path = '{}.{}.{}.tmp'.format(entry_path, os.getpid(),
+                                          threading.get_ident())
+        with open(temp_path, 'wb') as file:
+            np.save(file, image)
+        size = os.stat(temp_path).st_size
+
+        evictions = 0
+        with open(self._lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # an entry written by another process meanwhile is replaced
+                try:
+                    old_size = os.stat(entry_path).st_size
+                except FileNotFoundError:
+                    old_size = 0
+                os.replace(temp_path, entry_path)
+
+                total_bytes = self._read_size() + size - old_size
+                if total_bytes > self.max_bytes:
+                    total_bytes, evictions = self._evict_entries()
+                self._write_size(total_bytes)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        with self._lock:
+            self.current_bytes = total_bytes
+            self.evictions += evictions
+
+    def _evict_entries(self):
+        """
+        Delete the least recently used entries until the cache is at 90% of
+        its budget, the lock file must be held. Return the remaining bytes and
+        the number of evictions.
+        """
+        entries = [(entry.stat().st_mtime, entry.stat().st_size, entry.path)
+                   for entry in self._entries()]
+        entries.sort()
+        total_bytes = sum(entry[1] for entry in entries)
+        target_bytes = 0.9 * self.max_bytes
+
+        evictions = 0
+        for _, size, path in entries:
+            if total_bytes <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            evictions += 1
+        return total_bytes, evictions
+
+    def evict(self):
+        """
+        Evict the least recently used entries of all the processes, the lock
+        file serializes the evictions and the size updates between them.
+        """
+        with open(self._lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                total_bytes, evictions = self._evict_entries()
+                self._write_size(total_bytes)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        with self._lock:
+            self.current_bytes = total_bytes
+            self.evictions += evictions
+
+    def stats(self):
+        with self._lock:
+            requests = self.hits + self.misses
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'hit_rate': self.hits / requests if requests else 0.,
+                    'evictions': self.evictions,
+                    'bytes': self.current_bytes}
+
+
+class CachedImageSequence(ImageSequence):
+    """
+    Serve the images of a csv dataframe through an ImageCache: an image is
+    decoded once and read back from the cache in the following epochs.
+    """
+
+    def __init__(self,
+                 dataframe,
+                 directory: str,
+                 class_indices: dict,
+                 cache: ImageCache,
+                 data_generator,
+                 dataset_parameters,
+                 model_parameters,
+                 train: bool):
+        self.file_paths = [os.path.join(directory, file_name) for file_name
+                           in dataframe['subDirectory_filePath']]
+        self.cache = cache
+        self.face_margin = get_face_margin(dataset_parameters)
+        if self.face_margin is not None:
+            self.boxes = dataframe[dataset_parameters['box_labels']].values
+            self.mode = 'nearest_draft_face{}'.format(self.face_margin)
+        else:
+            self.boxes = None
+            self.mode = 'nearest_draft'
+        classes = dataframe[dataset_parameters['class_label']] \
+            .map(class_indices).values.astype('int32')
+
+        super(CachedImageSequence, self).__init__(classes,
+                                                  class_indices,
+                                                  data_generator,
+                                                  dataset_parameters,
+                                                  model_parameters,
+                                                  train)
+
+    def load_images(self, batch_index):
+        images = np.zeros((len(batch_index), self.image_height,
+                           self.image_width, 3), dtype='uint8')
+        for i, index in enumerate(batch_index):
+            file_path = self.file_paths[index]
+            key = self.cache.key(file_path,
+                                 (self.image_height, self.image_width),
+                                 self.mode)
+            image = self.cache.get(key)
+            if image is None:
+                image = load_image(file_path, self.image_height,
+                                   self.image_width,
+                                   box=None if self.boxes is None
+                                   else self.boxes[index],
+                                   margin=self.face_margin)
+                self.cache.put(key, image)
+            images[i] = image
+        return images
+
+    def on_epoch_end(self):
+        super(CachedImageSequence, self).on_epoch_end()
+        if self.cache.hits + self.cache.misses:
+            print('** image cache: {} **'.format(self.cache.stats()))
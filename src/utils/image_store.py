@@ -0,0 +1,53 @@
+import os
+import json
+import numpy as np
+
+from src.utils.sequences import ImageSequence
+from src.utils.sequences import get_face_margin
+
+"""
+Pre-resized uint8 image store: a contiguous N x H x W x 3 array saved as .npy
+(written by src/process_affectnet/create_image_store.py) that is memory
+mapped and sliced into batches, so no image is decoded during training.
+"""
+
+
+def open_image_store(store_directory: str):
+    images = np.load(os.path.join(store_directory, 'images.npy'), mmap_mode='r')
+    labels = np.load(os.path.join(store_directory, 'labels.npy'))
+    with open(os.path.join(store_directory, 'metadata.json')) as json_file:
+        metadata = json.load(json_file)
+    return images, labels, metadata
+
+
+class MemmapSequence(ImageSequence):
+    """
+    Serve batches by fancy-indexing a memory mapped image store.
+    """
+
+    def __init__(self,
+                 store_directory: str,
+                 data_generator,
+                 dataset_parameters,
+                 model_parameters,
+                 train: bool):
+        self.images, classes, metadata = open_image_store(store_directory)
+
+        if self.images.shape[1:3] != (model_parameters['image_height'],
+                                      model_parameters['image_width']):
+            raise ValueError('Image store does not match the model input size',
+                             store_directory, self.images.shape[1:3])
+
+        if metadata.get('face_margin') != get_face_margin(dataset_parameters):
+            raise ValueError('Image store face crop does not match the dataset',
+                             store_directory, metadata.get('face_margin'))
+
+        super(MemmapSequence, self).__init__(classes,
+                                             metadata['class_indices'],
+                                             data_generator,
+                                             dataset_parameters,
+                                             model_parameters,
+                                             train)
+
+    def load_images(self, batch_index):
+        return self.images[batch_index]
@@ -0,0 +1,202 @@
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+"""
+Compiled dataset manifest: an Arrow IPC file written next to a csv that
+holds the validated relative paths, integer class ids, face boxes and file
+sizes. It is memory mapped at start-up instead of parsing the csv, and the
+per-file existence checks of flow_from_dataframe are skipped while the
+manifest is fresh, i.e. while the csv and the image directory did not change.
+
+run: python -m src.utils.manifest -p /data/affectnet/training_modified_renamed.csv -d /data/affectnet/training
+"""
+
+MANIFEST_VERSION = 2
+box_labels = ['face_x', 'face_y', 'face_width', 'face_height']
+
+
+def get_class_indices(dataframe, class_label: str):
+    """
+    Same class ordering as flow_from_dataframe: sorted string labels
+    """
+    class_names = sorted(dataframe[class_label].unique())
+    return dict(zip(class_names, range(len(class_names))))
+
+
+def get_manifest_path(csv_file: str):
+    return os.path.splitext(csv_file)[0] + '.manifest.arrow'
+
+
+def get_class_names_path(csv_file: str):
+    """ lookup table of a csv with int8 coded labels """
+    return os.path.splitext(csv_file)[0] + '.classes.json'
+
+
+def get_quarantine_path(directory: str):
+    """ images flagged by fix_dataset/check_images.py """
+    return os.path.normpath(directory) + '.quarantine'
+
+
+def read_quarantine(directory: str):
+    """ relative paths of the quarantined images of a directory """
+    quarantine_path = get_quarantine_path(directory)
+    if not os.path.exists(quarantine_path):
+        return set()
+    with open(quarantine_path) as quarantine_file:
+        return set(quarantine_file.read().split())
+
+
+def drop_quarantined(dataframe, directory: str):
+    quarantine = read_quarantine(directory)
+    if not quarantine:
+        return dataframe
+    quarantined = dataframe['subDirectory_filePath'].isin(quarantine).values
+    if quarantined.any():
+        print('** dropped {} quarantined images **'.format(quarantined.sum()))
+        dataframe = dataframe[~quarantined].reset_index(drop=True)
+    return dataframe
+
+
+def read_csv_labels(csv_file: str, class_label: str = 'expression'):
+    """
+    Return the dataframe of a csv with its labels as strings, and its class
+    indices. The int8 codes of a csv written with a lookup table
+    (rename_expression_column --codes) are already the class indices and
+    become categorical labels without a string conversion.
+    """
+    class_names_path = get_class_names_path(csv_file)
+    if os.path.exists(class_names_path):
+        with open(class_names_path) as json_file:
+            class_names = json.load(json_file)
+        dataframe = pd.read_csv(csv_file, dtype={class_label: 'int8'})
+        dataframe[class_label] = pd.Categorical.from_codes(
+            dataframe[class_label].values, categories=class_names)
+        return dataframe, dict(zip(class_names, range(len(class_names))))
+
+    dataframe = pd.read_csv(csv_file)
+    dataframe[class_label] = dataframe[class_label].astype(str)
+    return dataframe, get_class_indices(dataframe, class_label)
+
+
+def _source_signature(csv_file: str, directory: str):
+    csv_stat = os.stat(csv_file)
+    quarantine_path = get_quarantine_path(directory)
+    return {'version': MANIFEST_VERSION,
+            'csv_size': csv_stat.st_size,
+            'csv_mtime': csv_stat.st_mtime,
+            'directory': os.path.abspath(directory),
+            # changes whenever a file is added to or removed from the folder
+            'directory_mtime': os.stat(directory).st_mtime,
+            'quarantine_mtime': os.stat(quarantine_path).st_mtime
+            if os.path.exists(quarantine_path) else None}
+
+
+def _file_size(file_path: str):
+    try:
+        return os.stat(file_path).st_size
+    except OSError:
+        return -1
+
+
+def compile_manifest(csv_file: str,
+                     directory: str,
+                     class_label: str = 'expression',
+                     workers: int = 32):
+    """
+    Parse the csv, stat every image once (in parallel) and write the
+    manifest. Missing, zero byte and quarantined images are dropped.
+    """
+    signature = _source_signature(csv_file, directory)
+
+    dataframe, class_indices = read_csv_labels(csv_file, class_label)
+    dataframe = drop_quarantined(dataframe, directory)
+
+    file_paths = [os.path.join(directory, file_name) for file_name
+                  in dataframe['subDirectory_filePath']]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        file_sizes = np.fromiter(executor.map(_file_size, file_paths),
+                                 dtype='int64', count=len(file_paths))
+
+    valid = file_sizes > 0
+    if not valid.all():
+        print('** manifest: dropped {} missing or empty images **'
+              .format(int((~valid).sum())))
+
+    columns = {
+        'subDirectory_filePath': dataframe['subDirectory_filePath'].values[valid],
+        'class_id': pd.Categorical(dataframe[class_label],
+                                   categories=list(class_indices))
+            .codes[valid].astype('int16'),
+        'file_size': file_sizes[valid],
+    }
+    if set(box_labels).issubset(dataframe.columns):
+        for box_label in box_labels:
+            columns[box_label] = dataframe[box_label].values[valid] \
+                .astype('float32')
+
+    table = pa.table(columns)
+    table = table.replace_schema_metadata({
+        'signature': json.dumps(signature),
+        'class_label': class_label,
+        'class_names': json.dumps(list(class_indices.keys()))})
+    # uncompressed so the file can be memory mapped
+    feather.write_feather(table, get_manifest_path(csv_file),
+                          compression='uncompressed')
+    return table
+
+
+def is_fresh(table, csv_file: str, directory: str):
+    metadata = table.schema.metadata or {}
+    if b'signature' not in metadata:
+        return False
+    return json.loads(metadata[b'signature']) == \
+        _source_signature(csv_file, directory)
+
+
+def load_manifest(csv_file: str,
+                  directory: str,
+                  class_label: str = 'expression'):
+    """
+    Return the dataframe of a csv dataset, with its labels as strings, and
+    its class indices. The manifest is (re)compiled if missing or stale.
+    """
+    manifest_path = get_manifest_path(csv_file)
+    table = None
+    if os.path.exists(manifest_path):
+        table = feather.read_table(manifest_path, memory_map=True)
+        if not is_fresh(table, csv_file, directory) or \
+                table.schema.metadata[b'class_label'].decode() != class_label:
+            print('** manifest {} is stale, recompiling **'.format(manifest_path))
+            table = None
+
+    if table is None:
+        table = compile_manifest(csv_file, directory, class_label)
+
+    class_names = json.loads(table.schema.metadata[b'class_names'])
+    dataframe = table.to_pandas()
+    # string labels for flow_from_dataframe without a per row conversion
+    dataframe[class_label] = pd.Categorical.from_codes(
+        dataframe['class_id'].values, categories=class_names)
+    return dataframe, dict(zip(class_names, range(len(class_names))))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+
+    parser = ArgumentParser()
+    parser.add_argument("-p", "--path",
+                        help="csv file of the dataset")
+    parser.add_argument("-d", "--directory",
+                        help="image directory of the csv")
+    parser.add_argument("-l", "--label", default='expression',
+                        help="label column")
+
+    args = parser.parse_args()
+
+    compile_manifest(args.path, args.directory, args.label)
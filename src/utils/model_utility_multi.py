@@ -2,7 +2,9 @@ import tensorflow as tf
 
 from src.utils.convert_json_dict import convert_keys_to_int
 from src.model_functions.WeightedSoftmaxCluster import ClusterLayer
+from src.model_functions.WeightedSoftmaxCluster import SparseClusterLayer
 from src.model_functions.WeightedSoftmaxCluster import WeightedSoftmaxLoss2
+from src.model_functions.WeightedSoftmaxCluster import SparseWeightedSoftmaxLoss2
 from src.model_functions.WeightedSoftmaxCluster import WeightedClusterLoss
 
 
@@ -106,15 +108,22 @@ def load_model(model_parameters, dataset_parameters):
             cl_weights = dataset_parameters['class_weights']
             print("class weights", cl_weights)
 
-            labels = tf.keras.Input(shape=(dataset_parameters['num_classes'],),
-                                    dtype='int32')
+            # int8 class ids from get_cluster_generator with "sparse_labels"
+            sparse_labels = dataset_parameters.get('sparse_labels', False)
+            if sparse_labels:
+                labels = tf.keras.Input(shape=(1,), dtype='int8')
+                cluster_layer = SparseClusterLayer
+            else:
+                labels = tf.keras.Input(shape=(dataset_parameters['num_classes'],),
+                                        dtype='int32')
+                cluster_layer = ClusterLayer
             inputs = tf.keras.Input(shape=(224, 224, 3), dtype='float32')
             x = model_template(inputs)
             x = tf.keras.layers.Dense(512, name='fc2')(x)
             x = tf.keras.layers.PReLU()(x)
             output = tf.keras.layers.Dense(dataset_parameters['num_classes'],
                                            name='output')(x)
-            cluster = ClusterLayer(
+            cluster = cluster_layer(
                 num_classes=dataset_parameters['num_classes'],
                 class_weight=cl_weights,
                 name='cluster')([x, labels])
@@ -124,10 +133,30 @@ def load_model(model_parameters, dataset_parameters):
 
             # compile the model
             # model_template.compile(loss={'output': tf.keras.losses.CategoricalCrossentropy(from_logits=True),
-            model_template.compile(loss={'output': WeightedSoftmaxLoss2(10, cl_weights, from_logits=True),
-                                'cluster': WeightedClusterLoss(cl_weights, _lambda=0.01)},
-                          optimizer=optimizer,
-                          metrics={'output': ['mae', tf.keras.metrics.CategoricalAccuracy()]})
+            # opt-in: one XLA cluster for the head, cluster layer and losses.
+            # With several replicas the step holds merge calls (optimizer,
+            # ONLY_FIRST_REPLICA center update, all_reduce) XLA cannot compile
+            jit_compile = model_parameters.get('jit_compile', False)
+            if jit_compile and strategy.num_replicas_in_sync > 1:
+                print('** jit_compile ignored with {} replicas **'
+                      .format(strategy.num_replicas_in_sync))
+                jit_compile = False
+            if jit_compile:
+                print('** train step compiled with XLA **')
+
+            if sparse_labels:
+                model_template.compile(loss={'output': SparseWeightedSoftmaxLoss2(dataset_parameters['num_classes'],
+                                                                                  cl_weights, from_logits=True),
+                                    'cluster': WeightedClusterLoss(cl_weights, _lambda=0.01)},
+                              optimizer=optimizer,
+                              metrics={'output': [tf.keras.metrics.SparseCategoricalAccuracy()]},
+                              jit_compile=jit_compile)
+            else:
+                model_template.compile(loss={'output': WeightedSoftmaxLoss2(10, cl_weights, from_logits=True),
+                                    'cluster': WeightedClusterLoss(cl_weights, _lambda=0.01)},
+                              optimizer=optimizer,
+                              metrics={'output': ['mae', tf.keras.metrics.CategoricalAccuracy()]},
+                              jit_compile=jit_compile)
         else:
             if model_parameters['loss'] == 'categorical_crossentropy':
                 loss = tf.keras.losses.CategoricalCrossentropy(
@@ -0,0 +1,273 @@
+import atexit
+import traceback
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+import tensorflow as tf
+
+"""
+Multi-process batch loader: decoding and augmentation of a keras iterator
+(flow_from_dataframe) or of an ImageSequence run in forked worker processes,
+which write the finished batches into a preallocated shared memory ring
+buffer of queue_depth slots.
+
+The parent decides the order of the batches and which slot each one is
+written to, so at most queue_depth batches are in flight and they are
+returned in order. Every batch is seeded from (seed, epoch, batch number),
+the augmentation is therefore deterministic whatever worker computes it.
+
+Iterating the loader yields views into the ring buffer without a copy. The
+tf.data dataset given to model.fit copies every batch once out of its slot,
+as tf may keep referencing the memory it converts.
+
+The image cache counters of a CachedImageSequence are counted in the
+workers and sent back with every batch, and the on_epoch_end of the
+sequence runs in the parent after every epoch, so its statistics stay
+those of the whole loader.
+"""
+
+
+def _get_batch(sequence, batch_index):
+    if hasattr(sequence, 'get_batch'):
+        return sequence.get_batch(batch_index)
+    # keras DataFrameIterator/ DirectoryIterator
+    return sequence._get_batches_of_transformed_samples(batch_index)
+
+
+def _get_cache(sequence):
+    """ the ImageCache of a CachedImageSequence, also behind a sampler """
+    while sequence is not None:
+        if hasattr(sequence, 'cache'):
+            return sequence.cache
+        sequence = getattr(sequence, 'sequence', None)
+    return None
+
+
+def _cache_counts(cache):
+    if cache is None:
+        return None
+    return cache.hits, cache.misses, cache.evictions
+
+
+def _worker_loop(sequence, images, labels, tasks, ready, seed):
+    cache = _get_cache(sequence)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+
+        epoch, batch_number, batch_index, slot = task
+        np.random.seed((seed + epoch * 100003 + batch_number) % 2 ** 32)
+        counts = _cache_counts(cache)
+        try:
+            batch = _get_batch(sequence, batch_index)
+            images[slot, :len(batch_index)] = batch[0]
+            labels[slot, :len(batch_index)] = batch[1]
+            error = None
+        except Exception:
+            error = traceback.format_exc()
+
+        # hits, misses and evictions of this batch, and the shared cache size
+        cache_delta = None
+        if cache is not None:
+            cache_delta = [new - old for new, old
+                           in zip(_cache_counts(cache), counts)]
+            cache_delta.append(cache.current_bytes)
+        ready.put((epoch, batch_number, error, cache_delta))
+
+
+class ProcessLoader:
+
+    def __init__(self, sequence, workers: int = 4, queue_depth: int = 8,
+                 seed: int = 0):
+        self.sequence = sequence
+        self.class_indices = sequence.class_indices
+        self.classes = sequence.classes
+        self.batch_size = sequence.batch_size
+        self.shuffle = sequence.shuffle
+        self.num_samples = len(sequence.classes)
+        self.queue_depth = queue_depth
+        self.seed = seed
+        self.epoch = 0
+        self._cache = _get_cache(sequence)
+        self._epoch_ended = True
+        self._outstanding = 0
+        self._closed = False
+
+        # compute one batch in the parent to size the ring buffer
+        images, labels = _get_batch(sequence, np.arange(min(self.batch_size,
+                                                            self.num_samples)))[:2]
+        self.image_shape = images.shape[1:]
+        self.label_shape = labels.shape[1:]
+        image_bytes = queue_depth * self.batch_size * \
+            int(np.prod(self.image_shape)) * 4
+        label_bytes = queue_depth * self.batch_size * \
+            int(np.prod(self.label_shape)) * 4
+
+        self._memory = shared_memory.SharedMemory(
+            create=True, size=image_bytes + label_bytes)
+        self._images = np.ndarray(
+            (queue_depth, self.batch_size) + self.image_shape,
+            dtype='float32', buffer=self._memory.buf)
+        self._labels = np.ndarray(
+            (queue_depth, self.batch_size) + self.label_shape,
+            dtype='float32', buffer=self._memory.buf, offset=image_bytes)
+
+        # fork: the workers inherit the sequence and the shared mapping
+        context = mp.get_context('fork')
+        self._tasks = context.Queue()
+        self._ready = context.Queue()
+        self._workers = [context.Process(target=_worker_loop,
+                                         args=(sequence,
+                                               self._images,
+                                               self._labels,
+                                               self._tasks,
+                                               self._ready,
+                                               seed),
+                                         daemon=True)
+                         for _ in range(workers)]
+        for worker in self._workers:
+            worker.start()
+        atexit.register(self.close)
+
+    def __len__(self):
+        if hasattr(self.sequence, 'epoch_batches'):
+            return len(self.sequence)
+        return int(np.ceil(self.num_samples / self.batch_size))
+
+    def _epoch_batches(self):
+        # ClassBalancedSampler draws its own batches, on_epoch_end draws the
+        # ones of the next epoch
+        if hasattr(self.sequence, 'epoch_batches'):
+            return self.sequence.batches
+        if self.shuffle:
+            order = np.random.RandomState(self.seed + self.epoch) \
+                .permutation(self.num_samples)
+        else:
+            order = np.arange(self.num_samples)
+        # sorted indices turn the random access into forward reads
+        return [np.sort(order[i:i + self.batch_size])
+                for i in range(0, self.num_samples, self.batch_size)]
+
+    def _receive(self):
+        """ next finished batch, its cache counters go to the parent cache """
+        epoch, batch_number, error, cache_delta = self._ready.get()
+        self._outstanding -= 1
+        if cache_delta is not None and self._cache is not None:
+            with self._cache._lock:
+                self._cache.hits += cache_delta[0]
+                self._cache.misses += cache_delta[1]
+                self._cache.evictions += cache_delta[2]
+                # the shared size a worker saw when it last wrote an entry
+                if cache_delta[1]:
+                    self._cache.current_bytes = cache_delta[3]
+        return epoch, batch_number, error
+
+    def _end_epoch(self):
+        self._epoch_ended = True
+        if hasattr(self.sequence, 'on_epoch_end'):
+            self.sequence.on_epoch_end()
+
+    def _drain(self):
+        # results of an epoch that was not consumed until the end
+        while self._outstanding:
+            self._receive()
+        if not self._epoch_ended:
+            self._end_epoch()
+
+    def __iter__(self):
+        """
+        Yield (images, labels) views into the ring buffer. A view is only
+        valid until the next batch is requested, then its slot is reused.
+        """
+        self._drain()
+        epoch = self.epoch
+        self.epoch += 1
+        self._epoch_ended = False
+        batches = self._epoch_batches()
+        free_slots = list(range(self.queue_depth))
+        slots = {}
+        done = set()
+        next_batch = 0
+
+        for batch_number in range(len(batches)):
+            # keep every free slot busy
+            while free_slots and next_batch < len(batches):
+                slot = free_slots.pop()
+                slots[next_batch] = slot
+                self._tasks.put((epoch, next_batch, batches[next_batch], slot))
+                self._outstanding += 1
+                next_batch += 1
+
+            while batch_number not in done:
+                _, finished, error = self._receive()
+                if error is not None:
+                    raise RuntimeError('ProcessLoader worker failed:\n' + error)
+                done.add(finished)
+            done.remove(batch_number)
+
+            slot = slots.pop(batch_number)
+            size = len(batches[batch_number])
+            yield self._images[slot, :size], self._labels[slot, :size]
+            free_slots.append(slot)
+
+        self._end_epoch()
+
+    def as_dataset(self):
+        """
+        tf.data view for model.fit. This path is not zero-copy: tf may keep
+        a reference to the numpy memory it converts, so each batch is copied
+        once out of its slot before the slot is reused.
+        """
+        def generator():
+            for images, labels in self:
+                yield np.copy(images), np.copy(labels)
+
+        dataset = tf.data.Dataset.from_generator(
+            generator,
+            output_signature=(
+                tf.TensorSpec((None,) + self.image_shape, tf.float32),
+                tf.TensorSpec((None,) + self.label_shape, tf.float32)))
+        dataset = dataset.prefetch(1)
+        dataset.class_indices = self.class_indices
+        dataset.classes = self.classes
+        dataset.loader = self
+        return dataset
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        self._memory.close()
+        self._memory.unlink()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def get_process_loader(generator, dataset_parameters):
+    """
+    Wrap a keras iterator or ImageSequence into a ProcessLoader dataset if
+    "loader_workers" is set, other generators are returned unchanged
+    """
+    workers = dataset_parameters.get('loader_workers', 0)
+    if not workers or generator is None or not hasattr(generator, 'classes') \
+            or isinstance(generator, tf.data.Dataset):
+        return generator
+
+    loader = ProcessLoader(generator,
+                           workers=workers,
+                           queue_depth=dataset_parameters.get(
+                               'loader_queue_depth', 8),
+                           seed=dataset_parameters.get('loader_seed', 0))
+    return loader.as_dataset()
@@ -0,0 +1,118 @@
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from src.utils.data_augmentation import get_preprocessing_function
+from src.utils.batch_augmentation import get_augmentation_parameters
+from src.utils.batch_augmentation import augment_batch
+
+
+def get_face_margin(dataset_parameters):
+    """
+    Margin (fraction of the box size added on each side) used to crop the
+    images to their box_labels, None if the images are not cropped
+    """
+    if dataset_parameters.get('face_crop', False):
+        return dataset_parameters.get('face_crop_margin', 0.)
+    return None
+
+
+def face_window(box, margin: float, width: int, height: int):
+    """
+    (left, top, right, bottom) of a face_x, face_y, face_width, face_height
+    box enlarged by margin and clipped to the image
+    """
+    x, y, box_width, box_height = box
+    left = int(max(x - margin * box_width, 0))
+    top = int(max(y - margin * box_height, 0))
+    right = int(min(x + (1 + margin) * box_width, width))
+    bottom = int(min(y + (1 + margin) * box_height, height))
+    return left, top, max(right, left + 1), max(bottom, top + 1)
+
+
+def load_image(file_path: str, image_height: int, image_width: int,
+               resample=Image.NEAREST, box=None, margin: float = 0.):
+    """
+    Decode an image as uint8 RGB array of the target size, optionally
+    cropped to its face box first.
+    Jpegs are decoded with DCT scaling (draft) to the smallest scale that is
+    still at least the target size, then resized.
+    nearest is the default interpolation of the keras iterators.
+    """
+    image = Image.open(file_path)
+    full_width, full_height = image.size
+
+    if box is None:
+        image.draft('RGB', (image_width, image_height))
+        image = image.convert('RGB')
+    else:
+        left, top, right, bottom = face_window(box, margin, full_width,
+                                               full_height)
+        # the crop, not the whole image, has to stay above the target size
+        image.draft('RGB', (int(np.ceil(image_width * full_width / (right - left))),
+                            int(np.ceil(image_height * full_height / (bottom - top)))))
+        scale_x = image.size[0] / full_width
+        scale_y = image.size[1] / full_height
+        image = image.convert('RGB').crop((int(left * scale_x),
+                                           int(top * scale_y),
+                                           int(np.ceil(right * scale_x)),
+                                           int(np.ceil(bottom * scale_y))))
+
+    image = image.resize((image_width, image_height), resample)
+    return np.asarray(image)
+
+
+class ImageSequence(tf.keras.utils.Sequence):
+    """
+    Base of the keras Sequences serving (images, one-hot labels) batches.
+    Subclasses implement load_images, which returns the uint8 images of the
+    requested indices.
+    """
+
+    def __init__(self,
+                 classes,
+                 class_indices: dict,
+                 data_generator,
+                 dataset_parameters,
+                 model_parameters,
+                 train: bool):
+        self.classes = classes
+        self.class_indices = class_indices
+        self.num_classes = dataset_parameters['num_classes']
+        self.batch_size = model_parameters['batch_size']
+        self.image_height = model_parameters['image_height']
+        self.image_width = model_parameters['image_width']
+        self.shuffle = train
+
+        # the keras data generator only provides the random transform ranges
+        self.augmentation = get_augmentation_parameters(data_generator)
+        self.preprocess_fn = get_preprocessing_function(dataset_parameters)
+
+        self.index_array = np.arange(len(self.classes))
+        self.on_epoch_end()
+
+    def load_images(self, batch_index):
+        raise NotImplementedError
+
+    def __len__(self):
+        return int(np.ceil(len(self.classes) / self.batch_size))
+
+    def __getitem__(self, index):
+        # sorted indices turn the random access into forward reads
+        batch_index = np.sort(self.index_array[index * self.batch_size:
+                                               (index + 1) * self.batch_size])
+        return self.get_batch(batch_index)
+
+    def get_batch(self, batch_index):
+        images = self.load_images(batch_index).astype('float32')
+        labels = tf.keras.utils.to_categorical(self.classes[batch_index],
+                                               self.num_classes)
+
+        if self.augmentation is not None:
+            images = augment_batch(images, self.augmentation)
+
+        return self.preprocess_fn(images), labels
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.index_array)
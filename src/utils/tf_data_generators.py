@@ -0,0 +1,291 @@
+import os
+import json
+import tensorflow as tf
+import numpy as np
+
+from src.utils.data_augmentation import get_data_generator
+from src.utils.data_augmentation import get_preprocessing_function
+from src.utils.batch_augmentation import get_augmentation_parameters
+from src.utils.batch_augmentation import augment_batch_tf
+from src.utils.sequences import get_face_margin
+
+"""
+tf.data input pipelines used by get_generator when the dataset configuration
+sets "input_pipeline": "tf_data".
+
+Images are decoded, resized and normalised in parallel inside the tf runtime
+instead of one by one in python as flow_from_dataframe does.
+"""
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+# read buffer per shard (bytes) and number of serialized records to shuffle
+TFRECORD_BUFFER = 8 * 1024 * 1024
+TFRECORD_SHUFFLE_BUFFER = 2048
+
+
+def decode_image(file_path, image_height: int, image_width: int):
+    image = tf.io.read_file(file_path)
+    return decode_image_bytes(image, image_height, image_width)
+
+
+def decode_jpeg_reduced(image, image_height: int, image_width: int):
+    """
+    Decode a jpeg with DCT scaling: the largest ratio (8, 4 or 2) for which
+    both sides stay at least as large as the target size, else full size.
+    """
+    shape = tf.image.extract_jpeg_shape(image)
+
+    def fits(ratio):
+        return tf.logical_and((shape[0] + ratio - 1) // ratio >= image_height,
+                              (shape[1] + ratio - 1) // ratio >= image_width)
+
+    return tf.case(
+        [(fits(8), lambda: tf.image.decode_jpeg(image, channels=3, ratio=8)),
+         (fits(4), lambda: tf.image.decode_jpeg(image, channels=3, ratio=4)),
+         (fits(2), lambda: tf.image.decode_jpeg(image, channels=3, ratio=2))],
+        default=lambda: tf.image.decode_jpeg(image, channels=3))
+
+
+def decode_image_bytes(image, image_height: int, image_width: int):
+    image = tf.cond(
+        tf.io.is_jpeg(image),
+        lambda: decode_jpeg_reduced(image, image_height, image_width),
+        lambda: tf.io.decode_image(image, channels=3, expand_animations=False))
+    # nearest is the default interpolation of the keras iterators
+    image = tf.image.resize(image, (image_height, image_width),
+                            method='nearest')
+    return image
+
+
+def face_window_tf(box, margin: float, shape):
+    """
+    [offset_y, offset_x, height, width] of a face_x, face_y, face_width,
+    face_height box enlarged by margin and clipped to the image shape
+    """
+    shape = tf.cast(shape[:2], tf.float32)
+    left = tf.maximum(box[0] - margin * box[2], 0.)
+    top = tf.maximum(box[1] - margin * box[3], 0.)
+    right = tf.minimum(box[0] + (1 + margin) * box[2], shape[1])
+    bottom = tf.minimum(box[1] + (1 + margin) * box[3], shape[0])
+    window = tf.cast(tf.stack([top, left, bottom - top, right - left]),
+                     tf.int32)
+    return tf.concat([window[:2], tf.maximum(window[2:], 1)], axis=0)
+
+
+def decode_face_bytes(image, box, margin: float,
+                      image_height: int, image_width: int):
+    """
+    Decode only the face window of a jpeg (decode_and_crop_jpeg), other
+    formats are decoded and cropped
+    """
+    def decode_jpeg_face():
+        window = face_window_tf(box, margin, tf.image.extract_jpeg_shape(image))
+        return tf.image.decode_and_crop_jpeg(image, window, channels=3)
+
+    def decode_other_face():
+        decoded = tf.io.decode_image(image, channels=3, expand_animations=False)
+        window = face_window_tf(box, margin, tf.shape(decoded))
+        return tf.image.crop_to_bounding_box(decoded, window[0], window[1],
+                                             window[2], window[3])
+
+    image = tf.cond(tf.io.is_jpeg(image), decode_jpeg_face, decode_other_face)
+    return tf.image.resize(image, (image_height, image_width),
+                           method='nearest')
+
+
+def finalize_dataset(dataset,
+                     dataset_parameters,
+                     model_parameters,
+                     train: bool):
+    """
+    Batch, augment, normalise and prefetch a dataset of (image, label) pairs.
+    The augmentation is the one of the keras data generator of the
+    configuration (flip, zoom, shift, rotation), see batch_augmentation.
+    """
+    num_classes = dataset_parameters['num_classes']
+    preprocess_fn = get_preprocessing_function(dataset_parameters)
+    # same random transforms as the keras data generator, applied per batch
+    augmentation = get_augmentation_parameters(
+        get_data_generator(dataset_parameters, train))
+
+    def preprocess(images, labels):
+        images = tf.cast(images, tf.float32)
+        if augmentation is not None:
+            images = augment_batch_tf(images, augmentation)
+        images = preprocess_fn(images)
+        labels = tf.one_hot(labels, num_classes)
+        return images, labels
+
+    dataset = dataset.batch(model_parameters['batch_size'])
+    dataset = dataset.map(preprocess, num_parallel_calls=AUTOTUNE)
+    return dataset.prefetch(AUTOTUNE)
+
+
+def get_csv_dataset(dataframe,
+                    directory: str,
+                    class_indices: dict,
+                    dataset_parameters,
+                    model_parameters,
+                    train: bool):
+    """
+    tf.data replacement of flow_from_dataframe(class_mode='categorical').
+    The returned dataset carries class_indices and classes as the keras
+    iterator does.
+    """
+    image_height = model_parameters['image_height']
+    image_width = model_parameters['image_width']
+
+    face_margin = get_face_margin(dataset_parameters)
+
+    file_paths = [os.path.join(directory, file_name) for file_name
+                  in dataframe['subDirectory_filePath']]
+    labels = dataframe[dataset_parameters['class_label']] \
+        .map(class_indices).values.astype('int32')
+    if face_margin is not None:
+        boxes = dataframe[dataset_parameters['box_labels']].values \
+            .astype('float32')
+    else:
+        boxes = np.zeros((len(labels), 4), dtype='float32')
+
+    dataset = tf.data.Dataset.from_tensor_slices((file_paths, labels, boxes))
+    if train:
+        # shuffle the file names only, before any decoding
+        dataset = dataset.shuffle(len(file_paths),
+                                  reshuffle_each_iteration=True)
+
+    def load(file_path, label, box):
+        if face_margin is not None:
+            image = decode_face_bytes(tf.io.read_file(file_path), box,
+                                      face_margin, image_height, image_width)
+        else:
+            image = decode_image(file_path, image_height, image_width)
+        return image, label
+
+    dataset = dataset.map(load, num_parallel_calls=AUTOTUNE)
+    dataset = finalize_dataset(dataset,
+                               dataset_parameters,
+                               model_parameters,
+                               train)
+
+    dataset.class_indices = class_indices
+    dataset.classes = labels
+    return dataset
+
+
+# features written by src/process_affectnet/create_tfrecords.py
+TFRECORD_FEATURES = {
+    'image': tf.io.FixedLenFeature([], tf.string),
+    'label': tf.io.FixedLenFeature([], tf.int64),
+    'box': tf.io.FixedLenFeature([4], tf.float32),
+}
+
+
+def parse_tfrecord_example(serialized_example):
+    return tf.io.parse_single_example(serialized_example, TFRECORD_FEATURES)
+
+
+def get_tfrecord_dataset(tfrecord_directory: str,
+                         dataset_parameters,
+                         model_parameters,
+                         train: bool):
+    """
+    Read the shards of a directory created by create_tfrecords.
+    Training shards are interleaved in parallel, validation shards are read
+    one after the other to keep the order of the csv (and of classes).
+    """
+    image_height = model_parameters['image_height']
+    image_width = model_parameters['image_width']
+    face_margin = get_face_margin(dataset_parameters)
+
+    with open(os.path.join(tfrecord_directory, 'metadata.json')) as json_file:
+        metadata = json.load(json_file)
+
+    file_pattern = os.path.join(tfrecord_directory, '*.tfrecord')
+    if train:
+        files = tf.data.Dataset.list_files(file_pattern, shuffle=True)
+        dataset = files.interleave(
+            lambda file: tf.data.TFRecordDataset(file,
+                                                 buffer_size=TFRECORD_BUFFER),
+            cycle_length=min(metadata['num_shards'], 16),
+            num_parallel_calls=AUTOTUNE,
+            deterministic=False)
+        dataset = dataset.shuffle(TFRECORD_SHUFFLE_BUFFER,
+                                  reshuffle_each_iteration=True)
+    else:
+        files = sorted(tf.io.gfile.glob(file_pattern))
+        dataset = tf.data.TFRecordDataset(files, buffer_size=TFRECORD_BUFFER)
+
+    def load(serialized_example):
+        example = parse_tfrecord_example(serialized_example)
+        if face_margin is not None:
+            image = decode_face_bytes(example['image'], example['box'],
+                                      face_margin, image_height, image_width)
+        else:
+            image = decode_image_bytes(example['image'], image_height,
+                                       image_width)
+        return image, tf.cast(example['label'], tf.int32)
+
+    dataset = dataset.map(load, num_parallel_calls=AUTOTUNE)
+    dataset = finalize_dataset(dataset,
+                               dataset_parameters,
+                               model_parameters,
+                               train)
+
+    dataset.class_indices = metadata['class_indices']
+    dataset.classes = np.load(os.path.join(tfrecord_directory, 'labels.npy'))
+    return dataset
+
+
+def sequence_to_dataset(sequence, dataset_parameters, model_parameters):
+    """
+    tf.data view of a keras Sequence (keras iterators included): batches are
+    fetched by parallel numpy_function calls and on_epoch_end is called when
+    a new epoch starts
+    """
+    image_shape = (None, model_parameters['image_height'],
+                   model_parameters['image_width'], 3)
+    label_shape = (None, dataset_parameters['num_classes'])
+
+    def epoch_indices():
+        sequence.on_epoch_end()
+        for index in range(len(sequence)):
+            yield index
+
+    def get_batch(index):
+        images, labels = sequence[int(index)][:2]
+        return images.astype('float32'), labels.astype('float32')
+
+    def load(index):
+        images, labels = tf.numpy_function(get_batch, [index],
+                                           [tf.float32, tf.float32])
+        images.set_shape(image_shape)
+        labels.set_shape(label_shape)
+        return images, labels
+
+    dataset = tf.data.Dataset.from_generator(
+        epoch_indices, output_signature=tf.TensorSpec((), tf.int64))
+    return dataset.map(load, num_parallel_calls=AUTOTUNE, deterministic=True)
+
+
+def get_cluster_dataset(generator, dataset_parameters, model_parameters):
+    """
+    Cluster loss inputs ([image, labels], [labels, dummy]) as a tf.data
+    dataset. The dummy target of the cluster output is built per batch from
+    the shape of its labels, so batches of any size match.
+    With "sparse_labels" the labels are int8 class ids of shape (batch, 1),
+    for the SparseClusterLayer, instead of one-hot floats.
+    """
+    sparse_labels = dataset_parameters.get('sparse_labels', False)
+    if not isinstance(generator, tf.data.Dataset):
+        generator = sequence_to_dataset(generator,
+                                        dataset_parameters,
+                                        model_parameters)
+
+    def to_cluster_inputs(images, labels):
+        if sparse_labels:
+            labels = tf.cast(tf.argmax(labels, axis=1)[:, None], tf.int8)
+        cluster = tf.zeros(tf.shape(labels)[:1], tf.float32)
+        return (images, labels), (labels, cluster)
+
+    dataset = generator.map(to_cluster_inputs, num_parallel_calls=AUTOTUNE)
+    return dataset.prefetch(AUTOTUNE)